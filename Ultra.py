@@ -1,16 +1,44 @@
+import time  # Tracking elapsed time
+START_TIME = time.perf_counter()  # When the program started, for --startup-time
 from abc import ABC, abstractmethod  # Define BaseScreen class (Abstract class) for all screens (Concrete classes)
-from customtkinter import *  # For GUI (Main)
-from tkinter import *  # For GUI
+from customtkinter import (CTk, CTkButton, CTkCheckBox, CTkEntry, CTkFont, CTkFrame, CTkImage, CTkLabel,  # For GUI (Main)
+                           CTkProgressBar, CTkSlider, set_appearance_mode)
+from tkinter import Button, Canvas, Checkbutton, Frame, IntVar, Label, Scrollbar, StringVar, Text, Toplevel  # For GUI
 from tkinter import messagebox, filedialog  # Provide dialog boxes.
+from tkinter import font as tkfont  # Font metrics for the playlist rows
 from PIL import Image  # Image handling
 from datetime import datetime, timedelta  # Manage login time and expiration
 import os  # File handling
 import pickle  # Saving and loading user data persistently
-import pygame.mixer as mixer  # Handling audio playback in the music player
 import re  # Matching password and password validation
-from mutagen.mp3 import MP3  # Extracts metadata (e.g. duration) from MP3 files
-import time  # Tracking elapsed time
+import hashlib  # Password hashing (scrypt, or PBKDF2 where scrypt isn't available)
+import hmac  # Constant-time password comparison
 import random  # Shuffle playback in a music player
+import sqlite3  # Persistent library index
+import threading  # Background directory scanning
+import queue  # Hands scan results from the worker thread to the Tk loop
+from collections import deque, OrderedDict  # Scan batches waiting for the UI, LRU metadata cache
+from concurrent.futures import Future, ThreadPoolExecutor  # Parses song metadata in the background
+import math  # Decibel conversions
+from array import array  # Compact track table columns
+from bisect import bisect_left  # Finds an entry among the filtered playlist rows
+import io  # Exposes an MP3 file from a frame offset to the mixer
+import struct  # Parses inotify events
+import atexit  # Writes pending session changes when the program ends
+import sys  # Command line options
+import importlib  # Imports the audio stack after the first screen is shown
+import importlib.util  # Checks for optional packages without importing them
+import json  # Instrumentation dumps
+import traceback  # Stack of the Tk thread when the UI stalls
+import cProfile  # On-demand profiling of a session
+import ctypes  # inotify calls for the folder watcher
+import ctypes.util
+import select  # Waits for inotify events
+import errno
+from audio_analysis import (UNPLAYABLE_FORMATS, Mp3FrameIndex, WaveformOverview, build_mp3_frame_index,  # Decoding in worker processes
+                            detect_format, start_pool, analyze_loudness, compute_waveform)
+
+SONG_EXTENSIONS = (".mp3", ".flac", ".ogg", ".oga", ".opus", ".wav", ".m4a")  # Files listed when a folder is loaded (any case)
 
 
 # BaseScreen: Abstract base class to ensure consistent structure for all derived screens.
@@ -20,6 +48,7 @@ class BaseScreen(ABC):
     def __init__(self, root):
         self.root = root  # Shared root window
         self.window = None  # Will be assigned when a screen is created
+        self.manager = None  # ScreenManager that switches to the other screens
 
 
     @abstractmethod
@@ -28,10 +57,22 @@ class BaseScreen(ABC):
         pass
 
 
+    @abstractmethod
+    def configure_root(self):
+        # Abstract method for the window title, size and icon, applied each time the screen is shown.
+        pass
+
+
+    def prepare(self, **options):
+        # Called by the screen manager when the screen is shown again, concrete classes reset their state here.
+        pass
+
+
     def show(self):
         # Displays the screen and ensures the root window is visible.
         if not self.window:
             self.create_widgets()   # Create widgets if haven't been initialized
+        self.configure_root()
         self.window.pack(fill="both", expand=True)  # Make the frame fill the window
         self.root.deiconify()  # Show the root window
 
@@ -43,6 +84,79 @@ class BaseScreen(ABC):
         self.root.withdraw()  # Hide the root window
 
 
+    def destroy(self):
+        # Destroys the screen's frame and all widgets inside it.
+        if self.window:
+            self.window.destroy()
+            self.window = None
+
+
+    def set_busy(self, button, busy):
+        # Disables the button and shows a spinner under it while a background task runs.
+        if busy:
+            button.configure(state="disabled")
+            info = button.place_info()
+            self.spinner = CTkProgressBar(self.window, mode="indeterminate", width=button.cget("width"), height=6, progress_color="RoyalBlue")
+            self.spinner.place(x=int(info["x"]), y=int(info["y"]) + button.cget("height") + 6)
+            self.spinner.start()
+        else:
+            self.spinner.stop()
+            self.spinner.destroy()
+            button.configure(state="normal")
+
+
+# ScreenManager: Creates each screen once and switches between them.
+# Screens are hidden instead of rebuilt, so going back and forth doesn't add widgets.
+class ScreenManager:
+    def __init__(self, root):
+        self.root = root
+        self.screens = {}  # Screen class -> screen
+        self.current = None  # Screen being shown
+
+
+    def show(self, screen_class, **options):
+        # Shows the screen of the class, creating it the first time.
+        screen = self.screens.get(screen_class)
+        if screen is None:
+            screen = screen_class(self.root, **options)
+            screen.manager = self
+            self.screens[screen_class] = screen
+        else:
+            screen.prepare(**options)
+        if self.current is not None and self.current is not screen:
+            self.current.hide()
+        self.current = screen
+        screen.show()
+        print(f"Showing {screen_class.__name__} ({self.widget_count()} widgets)")
+        return screen
+
+
+    def discard(self, screen_class):
+        # Destroys a screen and its widgets, it's created again the next time it's shown.
+        screen = self.screens.pop(screen_class, None)
+        if screen is not None:
+            if self.current is screen:
+                self.current = None
+            screen.destroy()
+
+
+    def close(self):
+        # Destroys all screens.
+        for screen_class in list(self.screens):
+            self.discard(screen_class)
+
+
+    def widget_count(self):
+        # Number of live widgets under the root window.
+        count = 0
+        pending = [self.root]
+        while pending:
+            children = pending.pop().winfo_children()
+            count += len(children)
+            pending.extend(children)
+        return count
+
+
 # Login screen class (inherits from BaseScreen)
 class LoginScreen(BaseScreen):
     def __init__(self, root):
@@ -52,37 +166,41 @@ class LoginScreen(BaseScreen):
         self.is_logged_in = self.load_login_state()   # Load login state from a file
         self.create_widgets()  # Create the UI elements for the login screen
 
+    def configure_root(self):
+        set_appearance_mode("light")  # Set light mode for the UI theme
+        self.root.title("Login to Ultra")  # # Set the window title
+        self.root.geometry("820x720")  # Set the window size
+        self.root.iconbitmap(assets.path("logo.ico"))  # Set the application icon
+        self.root.resizable(False, False)  # Disable resizing
+
+    def prepare(self):
+        # Clears the previous login when the screen is shown again.
+        self.username_entry.delete(0, "end")
+        self.password_entry.delete(0, "end")
+        self.load_login_info()
+
     def load_login_state(self):
-        # Loads the user's login state from a file, if it exists.
-        try:
-            with open("login_state.pkl", "rb") as file:
-                return pickle.load(file)  # Return the saved login state
-        except FileNotFoundError:
-            return False  # Automatically logging out if the file doesn't exist
+        # Returns whether the user chose to stay logged in.
+        return session_store.get("stay_logged_in")
 
     def create_widgets(self):
         print("Creating LoginScreen widgets...")
         self.window = CTkFrame(self.root, fg_color="lightblue")  # The main frame for the login screen
         self.window.pack(fill="both", expand=True)  
-        set_appearance_mode("light")  # Set light mode for the UI theme
-        self.root.title("Login to Ultra")  # # Set the window title
-        self.root.geometry("820x720")  # Set the window size
-        self.root.iconbitmap(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\logo.ico")  # Set the application icon (absolute path)
-        self.root.resizable(False, False)  # Disable resizing
 
         
     
-        self.logo_image = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\logo.png"),size=(250, 250))  # Load the program logo
+        self.logo_image = assets.image("logo.png", (250, 250))  # Load the program logo
 
         # Load images for password visibility toggle (eye icons)
-        self.eye_open = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\eye.png"), size=(20, 20))  # (absolute path)
-        self.eye_close = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\eye_closed.png"), size=(20, 20))  # (absolute path)
+        self.eye_open = assets.image("eye.png", (20, 20))
+        self.eye_close = assets.image("eye_closed.png", (20, 20))
 
          # Define custom fonts for labels and entries
-        self.label0_font = CTkFont(family="Times New Roman", size=120, weight='bold')
-        self.label1_font = CTkFont(family="Times New Roman", size=20, weight='bold')
-        self.label2_font = CTkFont(family="Times New Roman", size=16, weight='bold')
-        self.entry_font = CTkFont(family="Times New Roman", size=14)
+        self.label0_font = assets.font(120, bold=True)
+        self.label1_font = assets.font(20, bold=True)
+        self.label2_font = assets.font(16, bold=True)
+        self.entry_font = assets.font(14)
 
          # Display the logo at the top of the screen
         self.logo_label = CTkLabel(self.window, image=self.logo_image, bg_color='lightblue', text='')
@@ -149,8 +267,9 @@ class LoginScreen(BaseScreen):
     
             print("Exiting the program...")  # exit process for debugging.
 
-            with open("login_state.pkl", "wb") as file:  # Saves the state of the "Stay Logged In" checkbox to a file.
-                pickle.dump(self.stay_logged_in_cb.get(), file)
+            # Saves the state of the "Stay Logged In" checkbox, nobody is logged in now
+            session_store.update(stay_logged_in=False, remember_me=bool(self.stay_logged_in_cb.get()))
+            session_store.flush()
 
             self.root.quit()   # Closes the main application window and exits the program.
 
@@ -167,99 +286,72 @@ class LoginScreen(BaseScreen):
     def login(self):
         username = self.username_entry.get()  # Retrieves the username from the input field.
         password = self.password_entry.get()  # Retrieves the password from the input field.
-        users = self.load_user_data()  # Loads saved user data for authentication.
 
-        if username not in users:
+        # The password is checked on a worker thread (hashing is slow on purpose), the window stays responsive
+        self.set_busy(self.login_button, True)
+        run_in_background(self.root, lambda future: self.on_login_checked(username, future), check_credentials, username, password)
+
+
+    def on_login_checked(self, username, future):
+        self.set_busy(self.login_button, False)
+        if future.exception() is not None:
+            messagebox.showerror("Login Failed", f"Error checking password: {future.exception()}")
+            return
+        result = future.result()
+
+        if result == "unknown":
             # Displays an error message if the username does not exist in the saved data.
             messagebox.showerror("Login Failed", "Username not found.")
-        elif users[username] != password:
+        elif result == "incorrect":
             # Displays an error message if the entered password does not match the saved one.
             messagebox.showerror("Login Failed", "Incorrect password.")
         else:
-            # Saves login state to a file if login is successful.
-            with open("login_state.pkl", "wb") as file:
-                pickle.dump({"stay_logged_in":self.stay_logged_in_cb.get(),"username": username}, file)
+            # Saves login state if login is successful.
+            stay_logged_in = bool(self.stay_logged_in_cb.get())
+            session_store.update(stay_logged_in=stay_logged_in, remember_me=stay_logged_in, username=username)
 
             if self.stay_logged_in_cb.get():
                 # Optionally saves the user's credentials if they choose "Stay Logged In."
                 self.save_login_info(username)
             
              # Switches to the Music Player screen, if login session successful
-            self.hide()
-            MusicPlayerScreen(self.root, stay_logged_in=self.stay_logged_in_cb.get(), username=username).show()
+            self.manager.show(MusicPlayerScreen, stay_logged_in=bool(self.stay_logged_in_cb.get()), username=username)
 
 
     def authenticate_user(self, username, password):
-        users = self.load_user_data()  # Loads all registered users and their passwords.
-        return users.get(username) == password  # Returns True if the username exists and the password matches; otherwise, False.
-
-    
-    def load_user_data(self): 
-        if os.path.exists('user_data.pkl'):
-            try:
-                with open('user_data.pkl', 'rb') as file:
-                    users = pickle.load(file)  # Deserializes user data
-                    print("Loaded users:", users)  # Logs loaded data for debugging.
-                    if isinstance(users, dict):
-                        return users  # Returns user data if it is in the correct format.
-                    else:
-                        print("Error: User data is not in dictionary format.")
-            except (pickle.UnpicklingError, EOFError, Exception) as e:
-                # Logs errors during the data loading process.
-                print(f"Error loading user data: {e}")
-        
-        return {}  # Returns an empty dictionary if data is unavailable or invalid.
+        # Returns True if the username exists and the password matches; otherwise, False.
+        return check_credentials(username, password) == "ok"
 
 
     def save_login_info(self, username):
-        users = self.load_user_data()  # Retrieves existing user data.
-        password = self.password_entry.get()  # Retrieves the current password.
-        users[username] = password  # Updates or adds the user's credentials to the data.
-        
-        
-        with open('user_data.pkl', 'wb') as file:
-            pickle.dump(users, file)  # Saves updated user data.
-        
-        
         login_time = datetime.now()  # Captures the current time of login.
-        with open('login_info.pkl', 'wb') as file:
-            pickle.dump((username, login_time), file) # Saves the username and login timestamp for login tracking
+        session_store.update(remembered_user=username, login_time=login_time) # Saves the username and login timestamp for login tracking
 
         print(f"Saved login info for username: {username}")  # Login operation
 
 
     def load_login_info(self):
-        try:
-            with open("login_state.pkl", "rb") as file:
-                stay_logged_in = pickle.load(file)  # Retrieves the "Stay Logged In" state.
-
-            if stay_logged_in:  # Proceeds only if the user activated the stay logged in
-                if os.path.exists('login_info.pkl'):
-                    with open('login_info.pkl', 'rb') as file:
-                        data = pickle.load(file)  # Loads saved login info.
-                        print("Loaded login info data:", data)  # Display loaded login data
-
-                        
-                        if isinstance(data, tuple) and len(data) == 2:
-                            username, login_time = data  # Extracts username and login time.
-                            if datetime.now() - login_time < timedelta(days=15):
-                                self.username_entry.insert(0, username)
-                                return True
-                        else:
-                            print("Unexpected data format in login_info.pkl:", data)
-        except FileNotFoundError:
-            pass # Ignores if login state file is not found.
+        if session_store.get("remember_me"):  # The checkbox is left as it was at the last login or exit
+            self.stay_logged_in_cb.select()
+        else:
+            self.stay_logged_in_cb.deselect()
+
+        username = session_store.get("remembered_user")  # Saved by the last login with "Stay Logged In"
+        login_time = session_store.get("login_time")
+
+        if username and login_time:  # Proceeds only if the user activated the stay logged in
+            if datetime.now() - login_time < timedelta(days=15):
+                self.username_entry.insert(0, username)
+                return True
 
         return False  # Returns False if login state is not valid or absent.
 
 
     def open_resetpassword_screen(self):
-        self.hide()   # Hides the login screen
-        ResetPasswordScreen(self.root).show()  # Initializes and shows the reset password screen.
+        self.manager.show(ResetPasswordScreen)  # Hides the login screen and shows the reset password screen.
     
     def open_signup_screen(self):
-        self.hide()  # Hides the login screen
-        SignUpScreen(self.root).show()  # Initializes and shows the sign up screen.
+        self.manager.show(SignUpScreen)  # Hides the login screen and shows the sign up screen.
 
 
 
@@ -269,6 +361,19 @@ class ResetPasswordScreen(BaseScreen):
         super().__init__(root)  
         print("ResetPasswordScreen initialized.")
 
+    def configure_root(self):
+        # Set appearance mode and window properties
+        set_appearance_mode("light")
+        self.root.title("Reset Password")  # Set fixed size for the window
+        self.root.geometry("480x420")
+        self.root.iconbitmap(assets.path("logo.ico"))  # Set the window icon
+        self.root.resizable(False, False)  # Make the window non-resizable
+
+    def prepare(self):
+        # Clears the entries when the screen is shown again
+        for entry in (self.username_entry, self.new_password_entry, self.confirm_np_entry):
+            entry.delete(0, "end")
+
     def create_widgets(self):
         # Creates and configures all widgets for the Reset Password screen
         print("Creating ResetPasswordScreen widgets...")
@@ -278,23 +383,16 @@ class ResetPasswordScreen(BaseScreen):
         self.window = CTkFrame(self.root, fg_color="lightblue")
         self.window.pack(fill="both", expand=True)  # Pack the frame to expand in both directions
 
-        # Set appearance mode and window properties
-        set_appearance_mode("light")
-        self.root.title("Reset Password")  # Set fixed size for the window
-        self.root.geometry("480x420")
-        self.root.iconbitmap(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\logo.ico")  # Set the window icon
-        self.root.resizable(False, False)  # Make the window non-resizable
-
 
         # Load images for eye icons
-        self.eye_open = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\eye.png"), size=(20, 20))
-        self.eye_close = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\eye_closed.png"), size=(20, 20))
+        self.eye_open = assets.image("eye.png", (20, 20))
+        self.eye_close = assets.image("eye_closed.png", (20, 20))
 
 
         # Fonts for labels and entries
-        self.label1_font = CTkFont(family="Times New Roman", size=20, weight='bold')
-        self.entry_font = CTkFont(family="Times New Roman", size=14)
-        self.label2_font = CTkFont(family="Times New Roman", size=14, weight='bold')
+        self.label1_font = assets.font(20, bold=True)
+        self.entry_font = assets.font(14)
+        self.label2_font = assets.font(14, bold=True)
 
         # Username label and entry
         self.username_label = CTkLabel(self.window, text="Username", font=self.label1_font, bg_color='LightBlue')
@@ -350,8 +448,7 @@ class ResetPasswordScreen(BaseScreen):
     def Return_to_login_screen(self):
         # Navigates back to the Login screen
         print("Return to Login screen...")
-        self.hide()
-        LoginScreen(self.root).show()
+        self.manager.show(LoginScreen)
 
 
 
@@ -407,33 +504,28 @@ class ResetPasswordScreen(BaseScreen):
         username = self.username_entry.get()
         new_password = self.new_password_entry.get()
         confirm_np = self.confirm_np_entry.get()
-        users = self.load_user_data()
         
         if not self.is_valid_password(new_password, confirm_np):
             return  # If the password is invalid, it will return nothing
     
-        if username in users:
-            # Update the password if the username exists
-            users[username] = new_password
-            self.save_user_data(users)  # Save updated user data
+        # The new password is hashed on a worker thread
+        self.set_busy(self.reset_pw_button, True)
+        run_in_background(self.root, self.on_password_reset,
+                          lambda: credential_store.set_password(username, hash_password(new_password)))
+
+
+    def on_password_reset(self, future):
+        # Called on the Tk thread once the new password has been saved
+        self.set_busy(self.reset_pw_button, False)
+        if future.exception() is not None:
+            messagebox.showerror("Error", f"Error resetting password: {future.exception()}")
+        elif future.result():
+            # The password was updated because the username exists
             messagebox.showinfo("Success", "Password reset successfully.")
-            self.hide()  # Hide the current screen
-            LoginScreen(self.root).show()  # Show the login screen
+            self.manager.show(LoginScreen)  # Hide the current screen and show the login screen
         else:
             messagebox.showerror("Error", "Username not found.")  # Show error if username doesn't exist
 
-    def load_user_data(self):
-        # Loads user data from the pickle file
-        if os.path.exists('user_data.pkl'):
-            with open('user_data.pkl', 'rb') as file:
-                return pickle.load(file)  # Return the loaded user data
-        return {}  # Return an empty dictionary if the file doesn't exist
-
-    def save_user_data(self, users):
-        # Saves the updated user data to the pickle file
-        with open('user_data.pkl', 'wb') as file:
-            pickle.dump(users, file)  # Save the user data
-
 
 
 
@@ -444,33 +536,40 @@ class SignUpScreen(BaseScreen):
         print("SignUpScreen initialized.")
         # Calls the parent class and prints a message
 
-    def create_widgets(self):
-        print("Creating SignUpScreen widgets...")
-        # Creates the widgets for the sign-up screen
-        self.window = CTkFrame(self.root, fg_color="LightYellow")
-        self.window.pack(fill="both", expand=True)
-        # Creates a frame for the screen with a light yellow background and fills the window 
+    def configure_root(self):
         set_appearance_mode("light")
         # Sets the appearance mode to light
         self.root.title("Sign up to Ultra")
         self.root.geometry("820x740")
-        self.root.iconbitmap(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\logo.ico")
+        self.root.iconbitmap(assets.path("logo.ico"))
         self.root.config(bg="lightBlue")
         self.root.resizable(False, False)
         # Sets the window title, size, icon, background color, and prevents resizing
 
+    def prepare(self):
+        # Clears the entries when the screen is shown again
+        for entry in (self.username_entry, self.password_entry, self.confirm_password_entry):
+            entry.delete(0, "end")
+
+    def create_widgets(self):
+        print("Creating SignUpScreen widgets...")
+        # Creates the widgets for the sign-up screen
+        self.window = CTkFrame(self.root, fg_color="LightYellow")
+        self.window.pack(fill="both", expand=True)
+        # Creates a frame for the screen with a light yellow background and fills the window 
+
        
     
-        self.logo_image = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\logo.png"),size=(250, 250))
-        self.eye_open = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\eye.png"), size=(20, 20))
-        self.eye_close = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\eye_closed.png"), size=(20, 20))
+        self.logo_image = assets.image("logo.png", (250, 250))
+        self.eye_open = assets.image("eye.png", (20, 20))
+        self.eye_close = assets.image("eye_closed.png", (20, 20))
         # Loads images for the logo and eye icons used for password visibility toggling
 
 
-        self.label0_font = CTkFont(family="Times New Roman", size=120, weight='bold')
-        self.label1_font = CTkFont(family="Times New Roman", size=20, weight='bold')
-        self.label2_font = CTkFont(family="Times New Roman", size=16, weight='bold')
-        self.entry_font = CTkFont(family="Times New Roman", size=14)
+        self.label0_font = assets.font(120, bold=True)
+        self.label1_font = assets.font(20, bold=True)
+        self.label2_font = assets.font(16, bold=True)
+        self.entry_font = assets.font(14)
         # Defines different font styles for the labels and entry fields
 
 
@@ -545,8 +644,7 @@ class SignUpScreen(BaseScreen):
 
     def open_login_screen(self):
         print("Return to Login screen...")
-        self.hide()
-        LoginScreen(self.root).show()
+        self.manager.show(LoginScreen)
         # Hides the sign-up screen and shows the login screen
 
     
@@ -598,30 +696,12 @@ class SignUpScreen(BaseScreen):
         # Toggles the visibility of the confirm password field (show or hide password)
 
 
-    def load_user_data(self):
-        if os.path.exists('user_data.pkl'):
-            with open('user_data.pkl', 'rb') as file:
-                return pickle.load(file)
-        return {}
-        # Loads the user data from a file if it exists, otherwise returns an empty dictionary
-
-
-    def save_user_data(self, users):
-        with open('user_data.pkl', 'wb') as file:
-            pickle.dump(users, file)
-        # Saves the user data to a file using pickle
-
-
     def signup(self):
         # Retrieves the input values from the username, password, and confirm password entry fields
         username = self.username_entry.get()
         password = self.password_entry.get()
         confirm_password = self.confirm_password_entry.get()
 
-        
-        # Loads the existing user data from the file
-        users = self.load_user_data()
-
 
         # Checks if the password is valid and if the password and confirm password match
         if not self.is_valid_password(password, confirm_password):
@@ -629,21 +709,25 @@ class SignUpScreen(BaseScreen):
             # If the password is invalid, the function exits without further processing
         
 
-        # Checks if the username already exists in the user data
-        if username in users:
+        # Hashes the password on a worker thread and adds the user, unless the username already exists
+        self.set_busy(self.sign_up_button, True)
+        run_in_background(self.root, self.on_signed_up,
+                          lambda: credential_store.add_user(username, hash_password(password)))
+
+
+    def on_signed_up(self, future):
+        # Called on the Tk thread once the user has been added
+        self.set_busy(self.sign_up_button, False)
+        if future.exception() is not None:
+            messagebox.showerror("Error", f"Error creating account: {future.exception()}")
+        elif not future.result():
             # If the username already exists, show an error message
             messagebox.showerror("Error", "Username already exists.")
         else:
-            # If the username is new, adds the username and password to the user data
-            users[username] = password
-
-            # Saves the updated user data back to the file
-            self.save_user_data(users)
             messagebox.showinfo("Success", "Registration successful.")
 
             # When Registration successful, it will navigate back to login screen
-            self.hide()
-            LoginScreen(self.root).show()
+            self.manager.show(LoginScreen)
             
 
 
@@ -652,38 +736,67 @@ class MusicPlayerScreen(BaseScreen):
     def __init__(self, root, stay_logged_in=False, username="User"):
         # Initialize the music player screen with optional stay_logged_in and username parameters
         super().__init__(root)  
-        mixer.init()  # Initialize the mixer (used for audio playback)
+        self.engine = PlaybackEngine(root)  # Playback layer over the mixer, which is started by the first song
+        self.tracks = TrackTable()  # Songs of the playlist, the playlist rows hold their ids
+        self.positions = array("i")  # Playlist index of each song id, -1 once it was removed
+        self.search_index = SearchIndex()  # Names and tags of the playlist's songs, by song id
+        self.search_query = ""  # Text in the search box
+        self.indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-index")  # Applies index changes in order
         self.stay_logged_in = stay_logged_in
         print("MusicPlayerScreen initialized with username: {username}")
         self.username = username
         self.create_widgets()  # Call method to create UI elements
 
+    def configure_root(self):
+        set_appearance_mode("light")  # Set light appearance mode for the UI
+        self.root.title("Ultra")  # Set window title
+        self.root.geometry("750x770")  # Set window dimensions
+        self.root.iconbitmap(assets.path("logo.ico"))  # Set window icon
+        self.root.resizable(False, False)   # Disable resizing of the window
+
+    def prepare(self, stay_logged_in=False, username="User"):
+        # Called when the player is shown again after a logout, another user starts with an empty playlist
+        self.stay_logged_in = stay_logged_in
+        if username != self.username:
+            self.username = username
+            self.username_label.configure(text=f"{self.username}")
+            self.stop_watcher()
+            self.clear_playlist(self.playlist_listbox)
+            self.song_name.set("< No song selected >")
+            self.song_status.set("< Status >")
+
+    def destroy(self):
+        # Stops the background work of the screen before its widgets are destroyed
+        if self.scanner is not None:
+            self.scanner.cancel()
+            self.scanner = None
+        self.stop_watcher()
+        self.clock.stop()
+        self.root.unbind("<Control-D>")
+        self.debug_panel.close()
+        super().destroy()
+
     def create_widgets(self):
         # method UI components for the music player screen
         print("Creating MusicPlayerScreen widgets...")
         self.window = CTkFrame(self.root, fg_color="LightBlue")  # Create main window frame
         self.window.pack(fill="both", expand=True)  # Pack window to expand in both directions
-        set_appearance_mode("light")  # Set light appearance mode for the UI
-        self.root.title("Ultra")  # Set window title
-        self.root.geometry("750x770")  # Set window dimensions
-        self.root.iconbitmap(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\logo.ico")  # Set window icon
-        self.root.resizable(False, False)   # Disable resizing of the window
 
 
         # Load images for buttons (previous, play, pause, next, shuffle, volume, user icon)
-        self.prev_image = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\prev.png"),size=(40, 40))
-        self.play_image = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\play.png"), size=(50, 50))
-        self.pause_image = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\pause.png"), size=(50, 50))
-        self.next_image = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\next.png"), size=(40, 40))
-        self.shuffle_image = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\shuffle.png"),size=(65, 65))
-        self.volume_image = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\volume.png"), size=(40, 40))
-        self.user_icon = CTkImage(light_image=Image.open(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj\imgs\user_icon.png"), size=(40, 40))
+        self.prev_image = assets.image("prev.png", (40, 40))
+        self.play_image = assets.image("play.png", (50, 50))
+        self.pause_image = assets.image("pause.png", (50, 50))
+        self.next_image = assets.image("next.png", (40, 40))
+        self.shuffle_image = assets.image("shuffle.png", (65, 65))
+        self.volume_image = assets.image("volume.png", (40, 40))
+        self.user_icon = assets.image("user_icon.png", (40, 40))
 
 
         # Define fonts for various labels
-        self.label1_font = CTkFont(family="Times New Roman", size=20, weight= 'bold')
-        self.label2_font = CTkFont(family="Times New Roman", size=16, weight= 'bold')
-        self.song_font = CTkFont(family="Times New Roman", size=14)
+        self.label1_font = assets.font(20, bold=True)
+        self.label2_font = assets.font(16, bold=True)
+        self.song_font = assets.font(14)
 
 
         # Create and position UI components such as labels and buttons
@@ -694,7 +807,7 @@ class MusicPlayerScreen(BaseScreen):
 
 
         # Create logout label and bind click event to logout method
-        self.logout_label = CTkLabel(root, text="LOG OUT", font=self.label2_font, cursor="hand2", bg_color='lightblue', text_color='Red')
+        self.logout_label = CTkLabel(self.window, text="LOG OUT", font=self.label2_font, cursor="hand2", bg_color='lightblue', text_color='Red')
         self.logout_label.place(x=15, y=65)
         self.logout_label.bind("<Button-1>", lambda e: self.logout())
 
@@ -711,61 +824,83 @@ class MusicPlayerScreen(BaseScreen):
         self.current_index =IntVar()
 
 
-        self.song_name_label = CTkLabel(root, textvariable=self.song_name, font=self.label1_font, anchor="center", text_color='Black', bg_color='LightBlue')
+        self.song_name_label = CTkLabel(self.window, textvariable=self.song_name, font=self.label1_font, anchor="center", text_color='Black', bg_color='LightBlue')
         self.song_name_label.place(x= 275, y= 75)
 
-        self.status_label = CTkLabel(root, textvariable=self.song_status, font=self.label2_font, text_color="Black", bg_color='LightBlue')
+        self.status_label = CTkLabel(self.window, textvariable=self.song_status, font=self.label2_font, text_color="Black", bg_color='LightBlue')
         self.status_label.place(x= 345, y= 125)
 
 
         # Duration labels and seek bar to control song position
-        self.duration_label = CTkLabel(root, text="00:00", font=self.label2_font, text_color="Black", bg_color='LightBlue')
+        self.duration_label = CTkLabel(self.window, text="00:00", font=self.label2_font, text_color="Black", bg_color='LightBlue')
         self.duration_label.place(x=85, y=170)
 
         
-        self.seek_bar = CTkSlider(root, from_=0, to=100, number_of_steps=1000, command=self.on_seek_bar_change, width=500, button_hover_color= "DarkBlue", bg_color="LightBlue")
+        self.seek_bar = CTkSlider(self.window, from_=0, to=100, number_of_steps=1000, command=self.on_seek_bar_change, width=500, button_hover_color= "DarkBlue", bg_color="LightBlue")
         self.seek_bar.place(x= 126, y= 176)
 
         
-        self.duration_frame = CTkLabel(root, text="00:00", font=self.label2_font, text_color="Black", bg_color='LightBlue')
+        self.duration_frame = CTkLabel(self.window, text="00:00", font=self.label2_font, text_color="Black", bg_color='LightBlue')
         self.duration_frame.place(x= 630, y= 170)
 
+        # Waveform overview of the song, drawn under the seek bar
+        self.waveform_canvas = Canvas(self.window, width=500, height=20, bg="LightBlue", highlightthickness=0)
+        self.waveform_canvas.place(x= 126, y= 195)
+
         self.seek_bar.bind("<ButtonRelease-1>", lambda e: self.on_seek_bar_release(self.seek_bar.get()))
 
 
+        # Search box, filters the playlist as the user types
+        self.search_entry = CTkEntry(self.window, placeholder_text="Search songs", width=400, font=self.label2_font, corner_radius=15)
+        self.search_entry.place(x= 170, y= 343)
+        self.search_entry.bind("<KeyRelease>", lambda e: self.search())
+
+
          # Playlist frame with listbox and load button
-        self.playlist_frame = CTkFrame(root, width=600, height=300, corner_radius=15, bg_color="lightBlue")
+        self.playlist_frame = CTkFrame(self.window, width=600, height=300, corner_radius=15, bg_color="lightBlue")
         self.playlist_frame.pack(pady=10)
         self.playlist_frame.place(x=140, y=380)
-        self.playlist_listbox = Listbox(self.playlist_frame, width=60, height=15, font=self.song_font, bg='RoyalBlue', fg='white', selectbackground='#4169E1', highlightthickness=0)
+        self.playlist_listbox = VirtualListView(self.playlist_frame, width=60, height=15, font=self.song_font, bg='RoyalBlue', fg='white', selectbackground='DarkBlue', on_activate=self.play_selected,
+                                                formatter=lambda track: self.tracks.label(track), items=array("I"))
         self.playlist_listbox.pack(padx=30, pady=10)
         self.load_btn = CTkButton(self.playlist_frame, text="Load Songs", font= self.label2_font, fg_color= "RoyalBlue", hover_color="DarkBlue", corner_radius=20, command=lambda: self.load(self.playlist_listbox))
         self.load_btn.pack(side="bottom", pady=10)
 
 
         # Buttons for navigation (previous, play/pause, next, shuffle) and volume control
-        self.prev_btn = CTkLabel(root, text="", image=self.prev_image, fg_color="lightblue")
+        self.prev_btn = CTkLabel(self.window, text="", image=self.prev_image, fg_color="lightblue")
         self.prev_btn.place(x= 260, y= 220)
         self.prev_btn.bind("<Button-1>", lambda e: self.previous_song(self.playlist_listbox, self.current_index))
-        self.play_pause_btn = CTkLabel(root, text="", image= self.play_image, fg_color="lightblue")
+        self.play_pause_btn = CTkLabel(self.window, text="", image= self.play_image, fg_color="lightblue")
         self.play_pause_btn.place(x= 310, y= 215)
         self.play_pause_btn.bind("<Button-1>", lambda e: self.toggle_play_pause(self.song_status, self.playlist_listbox, self.current_index))
-        self.next_btn = CTkLabel(root, text="", image= self.next_image, fg_color="lightblue")
+        self.next_btn = CTkLabel(self.window, text="", image= self.next_image, fg_color="lightblue")
         self.next_btn.place(x= 380, y= 220)
         self.next_btn.bind("<Button-1>", lambda e: self.next_song(self.playlist_listbox, self.current_index))
-        self.shuffle_btn = CTkLabel(root, image=self.shuffle_image, text="", fg_color="lightblue")
+        self.shuffle_btn = CTkLabel(self.window, image=self.shuffle_image, text="", fg_color="lightblue")
         self.shuffle_btn.place(x= 435, y= 208)
-        self.shuffle_btn.bind("<Button-1>", lambda e: self.shuffle_playlist(self.playlist_listbox))
+        self.shuffle_btn.bind("<Button-1>", lambda e: self.shuffle_playlist(self.playlist_listbox))  # Toggles shuffle
 
 
         # Volume control slider and label
-        self.volume_label = CTkLabel(root, text="", image=self.volume_image, fg_color="lightblue")
+        self.volume_label = CTkLabel(self.window, text="", image=self.volume_image, fg_color="lightblue")
         self.volume_label.place(x= 255, y= 300)
-        self.volume_slider = CTkSlider(root, from_=0, to=100, number_of_steps=100, button_hover_color= "DarkBlue", bg_color="LightBlue", command=self.volume)
+        self.volume_slider = CTkSlider(self.window, from_=0, to=100, number_of_steps=100, button_hover_color= "DarkBlue", bg_color="LightBlue", command=self.volume)
         self.volume_slider.set(50)
         self.volume_slider.place(x= 300, y= 313)
 
 
+        # Gapless playback checkbox (the next song is queued in the mixer while the current one plays)
+        self.gapless_cb = CTkCheckBox(self.window, text="Gapless", font=self.label2_font, fg_color="RoyalBlue", hover_color="DarkBlue", bg_color="LightBlue", command=self.toggle_gapless)
+        self.gapless_cb.select()
+        self.gapless_cb.place(x= 520, y= 306)
+
+
+        # Folder watching checkbox (songs added, removed or renamed in the loaded folder show up in the playlist)
+        self.watch_cb = CTkCheckBox(self.window, text="Watch", font=self.label2_font, fg_color="RoyalBlue", hover_color="DarkBlue", bg_color="LightBlue", command=self.toggle_watcher)
+        self.watch_cb.place(x= 590, y= 345)
+
+
         # Initialize playback state variables
         self.elapsed_time = 0
         self.song_duration = 0
@@ -774,17 +909,31 @@ class MusicPlayerScreen(BaseScreen):
         self.last_update_time = 0
         self.is_seeking = False  
         self.is_playing = False
+        self.scanner = None  # Directory scanner while songs are being loaded
+        self.watcher = None  # Folder watcher of the loaded folder
+        self.current_path = None  # Full path of the song being played
+        self.queued_index = None  # Playlist index of the song queued for gapless playback
+        self.play_order = PlayOrder()  # Order of the songs for next/previous (playlist order or shuffled)
+        self.clock = PlaybackClock(self.root, self.play_time)  # Single owner of the playback time updates
+        self.shown_texts = {}  # Last text shown by each time label, unchanged texts aren't reconfigured
+        self.load_span = None  # Instrumentation span of the folder being loaded
+        self.debug_panel = DebugPanel(self.root)  # Hidden timing panel, toggled with Ctrl+Shift+D
+        self.root.bind("<Control-D>", lambda e: self.debug_panel.toggle())
 
    
             
     def exit_program(self):
         # Method to exit the program
         print("Exiting the program...")
+        if self.scanner is not None:
+            self.scanner.cancel()  # Stop loading songs
+        self.clock.stop()
+        metadata_service.close()  # Queued tag parsing would hold up the exit
         
 
-        # Save login state to pickle file
-        with open("login_state.pkl", "wb") as file:
-            pickle.dump({"stay_logged_in": self.stay_logged_in, "username": self.username}, file)
+        # Save login state
+        session_store.update(stay_logged_in=bool(self.stay_logged_in), username=self.username)
+        session_store.flush()
 
         self.root.quit()
 
@@ -792,24 +941,20 @@ class MusicPlayerScreen(BaseScreen):
     def logout(self):
         """Logout and return to the login screen."""
         print("Logging out...")     # Print a message indicating the logout process has started.
+        if self.scanner is not None:
+            self.scanner.cancel()  # Stop loading songs
+            self.scanner = None
+        self.clock.stop()  # No more playback time updates
+        self.engine.stop()  # Nothing plays on the login screen
+        self.is_playing = False
+        self.is_paused = False
+        self.play_pause_btn.configure(image=self.play_image)
         
-        try:
-            # Attempt to open the login state file in write-binary mode to save the new login state.
-            with open(login_state_path, "wb") as file:
-                # Serialize and save the login state, setting "stay_logged_in" to False and storing the current username.
-                pickle.dump({"stay_logged_in": False, "username": self.username}, file)
-        except Exception as e:
-            print(f"Error resetting login state: {e}")
-        
-
-        # Check if the file "login_info.pkl" exists in the file system.
-        if os.path.exists("login_info.pkl"):
-            # If the file exists, remove it to clear any stored session information
-            os.remove("login_info.pkl")
+        # Save the login state, setting "stay_logged_in" to False and clearing the remembered login
+        session_store.update(stay_logged_in=False, username=self.username, remembered_user=None, login_time=None)
 
 
-        self.hide()  # Hide current screen after logging out
-        LoginScreen(self.root).show()  # Show the login screen
+        self.manager.show(LoginScreen)  # Hide current screen and show the login screen
 
 
     def toggle_play_pause(self, status, song_list, current_index):
@@ -830,6 +975,7 @@ class MusicPlayerScreen(BaseScreen):
 
     # Method to play a song from the playlist
     def play_song(self, song_list, status, current_index):
+        span = instrumentation.start("click_to_audio")  # Ends when the mixer reports the song is playing
         try:
              # Reset elapsed and paused time if the song is not paused
             if not self.is_paused:
@@ -837,44 +983,33 @@ class MusicPlayerScreen(BaseScreen):
                 self.paused_time = 0
 
 
-            # Get the name of the song to be played
-            song_name = song_list.get(current_index.get())
-
-
-            # Check if the song directory is set, otherwise ask the user to select a directory
-            if not hasattr(self, 'song_directory') or not self.song_directory:
-                directory = filedialog.askdirectory(title="Select song directory")
-                self.song_directory = directory  # Save the selected directory
-            else:
-                directory = self.song_directory  # Use the existing directory
-
-            # Combine the directory and song name to get the full path of the song
-            full_path = os.path.join(directory, song_name) 
+            # Get the song to be played, its path comes from the track table
+            track = song_list.get(current_index.get())
+            full_path = self.tracks.path(track)
 
 
             # Print the selected song's full path for debugging
             print(f"Selected song: {full_path}")  
 
 
-            # Check if the song file exists, otherwise show an error message
-            if not os.path.isfile(full_path):
-                self.show_error(f"Song file not found: {full_path}")
+            # Stop any currently playing song and play the new one (the file is only loaded if it isn't open already)
+            self.engine.set_gain(loudness_analyzer.gain(full_path))  # Bring the song to the same loudness as the others
+            if not self.play_track(track, full_path, self.paused_time):
                 return
+            self.end_when_audible(span)
+
 
             # Get the song name without extension and shorten if it's too long
-            name_without_extension = os.path.splitext(song_name)[0]
+            name_without_extension = os.path.splitext(self.tracks.name(track))[0]  # Songs from subfolders show only their file name
             truncated_name = truncate_song_name(name_without_extension)
             self.song_name.set(truncated_name)  # Update the song name in the UI
 
             
-            # Stop any currently playing song and load the new one
-            mixer.music.stop()
-            mixer.music.load(full_path)
-            mixer.music.play(start=self.paused_time)
-
-            
-            # Get the song's duration
-            self.song_duration = get_song_duration(full_path)
+            # Get the song's duration and prepare the next song
+            self.current_path = full_path
+            self.show_song_duration(full_path, track)
+            self.show_waveform(full_path)
+            self.queue_next_song(song_list, current_index)
 
 
             # Update the status to "Playing..."
@@ -884,29 +1019,222 @@ class MusicPlayerScreen(BaseScreen):
             self.is_paused = False
 
             
-            # Update the play/pause button and seek bar UI
+            # Update the play/pause button UI
             self.play_pause_btn.configure(image=self.pause_image)
-            self.seek_bar.set(0)
-            self.seek_bar.configure(to=self.song_duration)
-            self.duration_frame.configure(text=f"{time.strftime('%M:%S', time.gmtime(self.song_duration))}")
 
             
-            # Start updating the song's playback tim
-            self.play_time(status, song_list, current_index)
+            # Start updating the song's playback time (restarting the clock cancels its pending tick)
+            self.clock.start()
 
         except Exception as e:
             # Handle any errors that occur while playing the song
             self.show_error(f"Error playing song: {str(e)}")
 
 
+    # Method to start a song in the engine, with the format detected from its magic bytes so the mixer picks the right decoder.
+    # Songs the mixer can't decode are refused without trying, and the file is only checked for when opening it fails.
+    # Songs that weren't probed yet are left to the mixer, their format is recorded when show_song_duration gets it.
+    # Returns False (after telling the user) if the song can't be played.
+    def play_track(self, track, full_path, start):
+        song_format = self.track_format(track, full_path)
+        if song_format is None:
+            self.show_error(f"Not a supported audio file: {full_path}")
+            return False
+        if song_format in UNPLAYABLE_FORMATS:
+            self.show_error(f"{song_format.upper()} songs can't be played by the mixer: {full_path}")
+            return False
+
+        try:
+            self.engine.play(full_path, start=start, song_format=song_format or None)
+        except (pygame.error, OSError):
+            if os.path.isfile(full_path):
+                if not song_format:
+                    self.wait_for_duration(metadata_service.fetch(full_path), full_path, self.tracks, track)  # Refused next time if it isn't playable
+                raise
+            self.show_error(f"Song file not found: {full_path}")
+            return False
+        return True
+
+
+    # Method to get the format of a song from the track table or the metadata cache, the file is never probed here.
+    # Returns None if it isn't a supported audio file, or "" if it wasn't probed yet.
+    def track_format(self, track, full_path):
+        if self.tracks.get_duration(track) is not None:  # Set with the format by index_tags
+            return self.tracks.get_format(track)
+        metadata = metadata_service.peek(full_path)
+        return metadata["format"] if metadata is not None else ""
+
+
+    # Method to tell whether a song is known to be unplayable: not a supported audio file, or a format the mixer can't decode.
+    def unplayable(self, track):
+        song_format = self.track_format(track, self.tracks.path(track))
+        return song_format is None or song_format in UNPLAYABLE_FORMATS
+
+
+    # Method to end an instrumentation span once the mixer reports that the song is playing.
+    # Polls every 5 ms, a span that doesn't get there within 2 seconds isn't recorded.
+    def end_when_audible(self, span, polls=400):
+        if span is None:
+            return
+        if self.engine.audible():
+            instrumentation.end(span)
+        elif polls > 0:
+            self.root.after(5, self.end_when_audible, span, polls - 1)
+
+
+    # Method to show the song's duration from the track table or the metadata cache, if it isn't parsed yet it is fetched in the background
+    def show_song_duration(self, full_path, track=None):
+        duration = self.tracks.get_duration(track) if track is not None else None
+        if duration is None:
+            metadata = metadata_service.peek(full_path)
+            duration = (metadata["duration"] or 0) if metadata else None
+        self.song_duration = duration or 0
+        if duration is None:
+            self.wait_for_duration(metadata_service.fetch(full_path), full_path, self.tracks, track)
+
+        self.seek_bar.set(0)
+        self.seek_bar.configure(to=max(self.song_duration, 1))
+        self.set_label_text(self.duration_frame, time.strftime('%M:%S', time.gmtime(self.song_duration)))
+
+
+    # Method to queue the next song in the mixer, so it starts without a gap when the current one ends
+    def queue_next_song(self, song_list, current_index):
+        self.queued_index = None
+        if not self.gapless_cb.get() or song_list.size() == 0:
+            return
+
+        next_index = self.play_order.peek_next(current_index.get())
+        track = song_list.get(next_index)
+        full_path = self.tracks.path(track)
+        try:
+            song_format = self.track_format(track, full_path)
+            if song_format is None or song_format in UNPLAYABLE_FORMATS:
+                return  # next_song reports it when it gets there
+            self.engine.queue(full_path, song_format or None)  # The mixer opens the file now and switches to it at the end of the stream
+        except (pygame.error, OSError) as e:
+            print(f"Error queueing song: {e}")  # A missing file is reported by next_song when it gets there
+            return
+        self.queued_index = next_index
+
+
+    # Method to turn gapless playback on or off
+    def toggle_gapless(self):
+        if self.gapless_cb.get() and self.is_playing:
+            self.queue_next_song(self.playlist_listbox, self.current_index)  # Prepare the next song right away
+
+
+    # Method to update the UI when the mixer has moved on to the queued song
+    def on_queued_song_started(self, status, song_list, current_index):
+        index, full_path, track = self.queued_index, self.engine.path, None
+        self.play_order.next(current_index.get())  # The queued song was the play order's next one
+        if index is not None and index < song_list.size():
+            track = song_list.get(index)
+            song_list.select_clear(0, "end")
+            song_list.select_set(index)
+            song_list.see(index)  # Scroll the playlist to the song
+            current_index.set(index)
+
+        # The queued song starts from the beginning
+        self.paused_time = 0
+        self.elapsed_time = 0
+        self.last_update_time = time.time()
+
+        self.current_path = full_path
+        self.engine.set_gain(loudness_analyzer.gain(full_path))
+        self.song_name.set(truncate_song_name(os.path.splitext(os.path.basename(full_path))[0]))
+        status.set("Playing...")
+        self.show_song_duration(full_path, track)
+        self.show_waveform(full_path)
+        self.queue_next_song(song_list, current_index)  # Prepare the song after it
+
+
+    # Method to apply the song's duration once the metadata service has parsed it
+    def wait_for_duration(self, future, full_path, table=None, track=None):
+        if not future.done():
+            self.root.after(50, self.wait_for_duration, future, full_path, table, track)  # Check again shortly
+            return
+        try:
+            metadata = future.result()
+        except Exception as e:
+            print(f"Error reading song duration: {e}")
+            return
+        if track is not None:
+            table.set_duration(track, metadata["duration"] or 0)
+            table.set_format(track, metadata["format"])
+        self.engine.set_format(full_path, metadata["format"])  # The song may have been started before it was probed
+        if self.current_path != full_path:
+            return  # Another song was started in the meantime
+        self.song_duration = metadata["duration"] or 0
+        self.seek_bar.configure(to=max(self.song_duration, 1))
+        self.set_label_text(self.duration_frame, time.strftime('%M:%S', time.gmtime(self.song_duration)))
+
+
+    # Method to draw the song's waveform overview, computed in a worker process the first time the song is played
+    def show_waveform(self, full_path):
+        self.waveform_canvas.delete("all")
+        if not waveform_service.enabled:
+            return
+        span = instrumentation.start("waveform_render")
+        overview = waveform_service.load(full_path)
+        if overview is None:
+            self.wait_for_waveform(waveform_service.fetch(full_path), full_path)
+            return
+        self.draw_waveform(overview)
+        instrumentation.end(span)
+
+
+    # Method to draw the waveform overview once the worker process has computed it
+    def wait_for_waveform(self, future, full_path):
+        if not future.done():
+            self.root.after(100, self.wait_for_waveform, future, full_path)  # Check again shortly
+            return
+        if self.current_path != full_path:
+            return  # Another song was started in the meantime
+        try:
+            blob = future.result()
+        except Exception as e:
+            print(f"Error computing waveform: {e}")
+            return
+        if blob is not None:
+            self.draw_waveform(WaveformOverview.from_blob(blob))
+
+
+    # Method to draw the envelope and the RMS level of the song as two polygons, one column per pixel
+    def draw_waveform(self, overview):
+        width = int(self.waveform_canvas.cget("width"))
+        middle = int(self.waveform_canvas.cget("height")) / 2
+        count = len(overview.low)
+        top, bottom, rms_top, rms_bottom = [], [], [], []
+        for x in range(width):
+            first = x * count // width
+            last = max((x + 1) * count // width, first + 1)
+            level = max(overview.rms[first:last]) * middle / 255
+            top.append((x, middle - max(overview.high[first:last]) * middle / 128))
+            bottom.append((x, middle - min(overview.low[first:last]) * middle / 128))
+            rms_top.append((x, middle - level))
+            rms_bottom.append((x, middle + level))
+        self.waveform_canvas.delete("all")
+        self.waveform_canvas.create_polygon(top + bottom[::-1], fill="SteelBlue", outline="")
+        self.waveform_canvas.create_polygon(rms_top + rms_bottom[::-1], fill="DarkBlue", outline="")
+
+
+    # Method to play the song that was double-clicked (or chosen with Enter) in the playlist
+    def play_selected(self, index):
+        self.play_order.jump(self.current_index.get(), index)
+        self.current_index.set(index)
+        self.is_paused = False  # Start the song from the beginning
+        self.play_song(self.playlist_listbox, self.song_status, self.current_index)
+
+
     # Method to pause the currently playing song
     def pause_song(self, status):
         try:
             # If a song is currently playing, pause it
             if self.is_playing:
-                mixer.music.pause()
+                self.engine.pause()
+                self.clock.stop()  # Nothing to update while paused
                 self.is_paused = True
-                self.paused_time = self.elapsed_time  # Save the time when the song was paused
+                self.paused_time = self.elapsed_time = self.engine.position()  # Save the time when the song was paused
                 status.set("Paused")  # Update the status to "Paused"
                 self.play_pause_btn.configure(image=self.play_image)  # Change button to play image
                 self.is_playing = False
@@ -920,27 +1248,28 @@ class MusicPlayerScreen(BaseScreen):
 
     # Method to resume a paused song
     def resume_song(self, status, song_list, current_index):
+        span = instrumentation.start("resume_song")
         try:
             # If the song is paused, resume playback from the paused time
             if self.is_paused:
-                song_name = song_list.get(current_index.get())
-                directory = self.song_directory  # Use the stored song directory
-                full_path = os.path.join(directory, song_name)  # Get full path of the song
-
-
-                 # Check if the song file exists, otherwise show an error message
-                if not os.path.isfile(full_path):
-                    self.show_error(f"Song file not found: {full_path}")
-                    return
+                if self.engine.paused and self.engine.path == self.current_path:
+                    self.engine.resume()  # The song is still open in the mixer, just unpause it
+                else:
+                    track = song_list.get(current_index.get())
+                    full_path = self.tracks.path(track)  # Get full path of the song
 
 
-                # Reload and resume the song from the paused time
-                mixer.music.load(full_path)
-                mixer.music.play(start=self.paused_time)
+                    # Play the song again from the paused time
+                    self.engine.set_gain(loudness_analyzer.gain(full_path))
+                    if not self.play_track(track, full_path, self.paused_time):
+                        return
+                    self.current_path = full_path
+                    self.queue_next_song(song_list, current_index)  # Prepare the next song again
+                self.end_when_audible(span)
                 status.set("Playing...")
                 self.is_paused = False
                 self.last_update_time = time.time()  # Update the last update time
-                self.play_time(status, song_list, current_index)  # Continue tracking playback time
+                self.clock.start()  # Continue tracking playback time
                 self.play_pause_btn.configure(image=self.pause_image)  # Change button to pause image
                 self.is_playing = True
         except Exception as e:
@@ -951,22 +1280,32 @@ class MusicPlayerScreen(BaseScreen):
     # Method to load songs from a selected directory into the playlist
     def load(self, listbox):
         try:
+            # Clicking the button while a scan is running cancels it
+            if self.scanner is not None:
+                self.scanner.cancel()
+                self.scanner = None
+                self.load_span = None  # A cancelled load isn't measured
+                self.load_btn.configure(text="Load Songs")
+                print("Loading cancelled.")
+                return
+
             # Ask the user to select a directory containing songs
             directory = filedialog.askdirectory(title="Open a song Directory")
             if directory:
-                tracks = os.listdir(directory)  # List all files in the selected directory
-                listbox.delete(0, "end")  # Clear the playlist
-
-
-                # Loop through all files and add .mp3 files to the playlist
-                for track in tracks:
-                    if track.endswith('.mp3'):
-                        song_path = os.path.join(directory, track)
-                        
-                        song_name = os.path.basename(song_path)  # Get the song's name 
-                        listbox.insert("end", song_name)  # Add song to the playlist
-                        
-                print(f"Loaded songs from: {directory}")
+                self.stop_watcher()
+                self.clear_playlist(listbox)
+                self.song_directory = directory  # Folder shown in the playlist and watched for changes
+                metadata_service.cancel_prefetch()  # The previous folder's songs aren't needed anymore
+
+
+                # Scan on a worker thread, the songs are added to the playlist in batches as they are found
+                self.load_span = instrumentation.start("load", directory=directory)
+                self.scanner = DirectoryScanner(
+                    self.root, directory,
+                    on_batch=lambda entries: self.on_load_batch(listbox, directory, entries),
+                    on_progress=lambda found: self.load_btn.configure(text=f"Cancel ({found})"),
+                    on_done=self.on_load_done)
+                self.scanner.start()
             else:
                 print("No directory selected.")  # If no directory is selected, print message
         except Exception as e:
@@ -974,68 +1313,253 @@ class MusicPlayerScreen(BaseScreen):
             self.show_error(f"Error loading songs: {str(e)}")
 
 
+    # Method to empty the playlist, the songs of the next one get new ids
+    def clear_playlist(self, listbox):
+        listbox.delete(0, "end")
+        self.play_order.reset()
+        self.tracks = TrackTable()
+        self.positions = array("i")
+        self.search_index.clear()
+
+
+    # Method called with each batch of songs found by the directory scanner, entries are (relative path, size, mtime_ns)
+    def on_load_batch(self, listbox, directory, entries):
+        first = listbox.size()
+        tracks = self.tracks.add(directory, entries)
+        listbox.insert("end", *tracks)  # Add the songs to the playlist, in increasing id order
+        self.positions.extend(range(first, first + len(tracks)))
+        self.play_order.resize(listbox.size())
+        paths = [self.tracks.path(track) for track in tracks]
+        chunks = metadata_service.prefetch(paths)  # Parse durations ahead of time
+        loudness_analyzer.analyze(paths)  # Measure loudness in the worker processes
+        self.index_batch(tracks, paths, chunks)
+
+
+    # Method to add songs to the search index on the indexer thread, their tags and durations follow once they're parsed
+    def index_batch(self, tracks, paths, chunks):
+        table, generation = self.tracks, self.search_index.generation
+        run_in_background(self.root, lambda future: self.search() if self.search_query else None,
+                          self.search_index.add, generation, [(track, os.path.splitext(table.label(track))[0]) for track in tracks],
+                          executor=self.indexer)  # New matches show up in the filtered playlist
+
+        ids = dict(zip(paths, tracks))
+        for future in chunks:
+            future.add_done_callback(lambda future: self.indexer.submit(self.index_tags, table, generation, ids, future))
+
+
+    # Method called on the indexer thread when a chunk of songs is parsed, adds their tags to the search index
+    def index_tags(self, table, generation, ids, future):
+        try:
+            found = [(ids[path], metadata) for path, metadata in future.result() if path in ids]
+        except Exception:
+            return  # The song keeps its name in the index
+        for track, metadata in found:
+            table.set_duration(track, metadata["duration"] or 0)  # Read by show_song_duration without a lookup
+            table.set_format(track, metadata["format"])  # Read by play_track
+        self.search_index.add(generation, [(track, " ".join(metadata[key] or "" for key in ("title", "artist", "album")))
+                                           for track, metadata in found])
+
+
+    # Method to start or stop watching the loaded folder
+    def toggle_watcher(self):
+        if self.watch_cb.get() and self.scanner is None and getattr(self, "song_directory", None):
+            self.start_watcher()
+        elif not self.watch_cb.get():
+            self.stop_watcher()
+
+
+    def start_watcher(self):
+        self.stop_watcher()
+        known = [self.tracks.label(track) for track in self.playlist_listbox.items]
+        self.watcher = FolderWatcher(self.root, self.song_directory, known, self.on_folder_changes)
+        self.watcher.start()
+
+
+    def stop_watcher(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+
+    # Method to apply the changes seen by the folder watcher to the playlist, the folder isn't scanned again.
+    # Renamed songs keep their place, removed ones are taken out and new ones are added at the end.
+    def on_folder_changes(self, added, removed, renamed):
+        listbox = self.playlist_listbox
+        if removed or renamed:
+            found = self.tracks.find(self.song_directory, list(removed) + list(renamed))
+
+        if renamed:
+            tracks, paths = [], []
+            for old, new in renamed.items():
+                track = found.get(old)
+                if track is None:
+                    continue
+                old_path = self.tracks.path(track)
+                self.tracks.rename(track, self.song_directory, new)
+                self.engine.rename(old_path, self.tracks.path(track))  # The current or the queued song
+                if self.current_path == old_path:
+                    self.current_path = self.tracks.path(track)
+                tracks.append(track)
+                paths.append(self.tracks.path(track))
+            listbox.schedule_redraw()  # The rows show the new names
+            self.indexer.submit(self.search_index.forget, self.search_index.generation, tracks)
+            self.index_batch(tracks, paths, metadata_service.prefetch(paths))
+
+        if removed:
+            self.remove_songs(sorted(self.positions[found[name]] for name in removed if name in found))
+        if added:
+            entries = []
+            for name in added:
+                try:
+                    stat = os.stat(os.path.join(self.song_directory, name))
+                except OSError:
+                    continue  # Gone again, the watcher reports it
+                entries.append((name, stat.st_size, stat.st_mtime_ns))
+            self.on_load_batch(listbox, self.song_directory, entries)
+        print(f"Folder changed: {len(added)} added, {len(removed)} removed, {len(renamed)} renamed")
+
+
+    # Method to take songs out of the playlist, the songs after them move up
+    def remove_songs(self, indices):
+        if not indices:
+            return
+        listbox = self.playlist_listbox
+        tracks = [listbox.get(index) for index in indices]
+        mapping = removal_mapping(listbox.size(), indices)
+        listbox.remove(mapping)
+        self.play_order.remove(mapping, listbox.size())
+
+        # A removed current song is followed by the song that came after it
+        current = self.current_index.get()
+        if 0 <= current < len(mapping):
+            if mapping[current] >= 0:
+                self.current_index.set(mapping[current])
+            else:
+                self.current_index.set(max(min(current - bisect_left(indices, current), listbox.size() - 1), 0))
+        if self.queued_index is not None:
+            if mapping[self.queued_index] >= 0:
+                self.queued_index = mapping[self.queued_index]
+            else:
+                self.queue_next_song(listbox, self.current_index)  # Replaces the removed song in the mixer
+
+        # Song ids don't change, the removed songs are only taken out of the search index
+        for track in tracks:
+            self.tracks.remove(track)
+            self.positions[track] = -1
+        for index in range(indices[0], listbox.size()):
+            self.positions[listbox.items[index]] = index  # The songs after the first removed one moved up
+        self.indexer.submit(self.search_index.forget, self.search_index.generation, tracks)
+
+
+    # Method to filter the playlist to the songs matching the search box, the playlist itself isn't changed
+    def search(self):
+        span = instrumentation.start("search_keystroke")
+        self.search_query = self.search_entry.get()
+        matches = self.search_index.search(self.search_query)
+        if matches is not None:
+            positions = self.positions  # Song ids increase along the playlist, so the rows stay sorted
+            matches = [positions[track] for track in matches if positions[track] >= 0]
+        self.playlist_listbox.set_filter(matches)
+        instrumentation.end(span)
+
+
+    # Method called when the directory scanner has finished
+    def on_load_done(self, found, error):
+        self.scanner = None
+        if self.load_span is not None and found:
+            elapsed = time.perf_counter() - self.load_span[1]
+            instrumentation.record("load_per_1k_files", self.load_span[1], elapsed * 1000 / found, {"files": found})
+        instrumentation.end(self.load_span, files=found)
+        self.load_span = None
+        self.load_btn.configure(text="Load Songs")  # Restore the button
+        if error is not None:
+            self.show_error(f"Error loading songs: {str(error)}")
+        elif self.watch_cb.get():
+            self.start_watcher()
+        print(f"Loaded {found} songs from: {self.song_directory}")
+
+
     # Method to adjust the volume of the song based on the slider value
     def volume(self, x):
         self.value =self.volume_slider.get()  # Get the current slider value
-        mixer.music.set_volume(self.value / 100)  # Set the volume (range 0 to 1)
+        self.engine.set_volume(self.value / 100)  # Set the volume (range 0 to 1)
 
 
-    # Method to track and display the current playback time of the song
-    def play_time(self, status, song_list, current_index):
+    # Method to track and display the current playback time of the song, called by the playback clock
+    def play_time(self):
         if self.is_paused or self.is_seeking:
-            return  # Do nothing if the song is paused or the user is seeking
+            return False  # Stop ticking if the song is paused or the user is seeking
+
+
+        # The end of the song is driven by the mixer's end of stream, not by the clock
+        ended = self.engine.poll_end()
+        if ended == "queued":
+            self.on_queued_song_started(self.song_status, self.playlist_listbox, self.current_index)  # The mixer already plays it
+        elif ended == "finished":
+            self.song_status.set("Finished!")
+            self.next_song(self.playlist_listbox, self.current_index)  # Restarts the clock
+            return False
         
 
-        # Get the current playback time from the mixer
-        current_time = mixer.music.get_pos() / 1000
-        self.elapsed_time = self.paused_time + current_time
+        # Get the current playback time from the engine's monotonic clock
+        self.elapsed_time = self.engine.position()
+        if self.song_duration:
+            self.elapsed_time = min(self.elapsed_time, self.song_duration)
 
-        # Format and display the current time and song duration
+        # Format and display the current time and song duration, widgets are only touched when their text changes
         formatted_time = time.strftime('%M:%S', time.gmtime(self.elapsed_time))
         formatted_duration = time.strftime('%M:%S', time.gmtime(self.song_duration))
-        self.duration_label.configure(text=f"{formatted_time}")
-        self.duration_frame.configure(text=f"{formatted_duration}")
-        self.seek_bar.set(self.elapsed_time)
+        self.set_label_text(self.duration_label, formatted_time)
+        self.set_label_text(self.duration_frame, formatted_duration)
 
-        
-        # If the song is finished, update the status and play the next song
-        if self.elapsed_time >= self.song_duration - 1:
-            status.set("Finished!")
-            self.next_song(song_list, current_index)
-            return
 
+        # Move the seek bar only when it moves by at least one pixel
+        step = max(self.song_duration, 1) / self.seek_bar.cget("width")
+        if abs(self.seek_bar.get() - self.elapsed_time) >= step:
+            self.seek_bar.set(self.elapsed_time)
+        return True  # Keep ticking
 
-         # Continue updating the playback time every second
-        self.root.after(1000, self.play_time, status, song_list, current_index)
 
+    # Method to configure a label's text only if it changed since the last update
+    def set_label_text(self, label, text):
+        if self.shown_texts.get(str(label)) != text:
+            label.configure(text=text)
+            self.shown_texts[str(label)] = text
 
-    # Method to shuffle the playlist and start playing from the first song
-    def shuffle_playlist(self,playlist):
-        shuffled = list(playlist.get(0, "end"))  # Get all songs from the playlist
-        random.shuffle(shuffled)  # Shuffle the songs
-        playlist.delete(0, "end")  # Clear the playlist
-        for song in shuffled:
-            playlist.insert("end", song)  # Insert shuffled songs back into the playlist
 
-        playlist.select_clear(0, "end")
-        playlist.select_set(0)  # Select the first song
-        self.current_index.set(0)  # Update the current song index
-        
-        self.play_song(playlist, self.song_status, self.current_index)  # Start playing
+    # Method to turn shuffle on (and start a random song) or off (back to the playlist order), the playlist isn't reordered
+    def shuffle_playlist(self, playlist):
+        if playlist.size() == 0:
+            return
+        shuffled = not self.play_order.shuffled
+        self.play_order.set_shuffle(shuffled, self.current_index.get())
+        self.shuffle_btn.configure(fg_color="LightSteelBlue" if shuffled else "lightblue")  # Show whether shuffle is on
+
+        if shuffled:
+            self.next_song(playlist, self.current_index)  # Start playing a random song
+        elif self.is_playing:
+            self.queue_next_song(playlist, self.current_index)  # The next song follows the playlist order again
 
 
     # Method to play the next song in the playlist
     def next_song(self, playlist, current_index):
-        mixer.music.stop()  # Stop the current song
+        self.engine.stop()  # Stop the current song
         self.elapsed_time = 0
         self.paused_time = 0
         self.is_playing = False
 
 
-        # Move to the next song (loop back to the first song if at the end)
-        next_index = (current_index.get() + 1) % playlist.size()
+        # Move to the next song in the play order (loops back to the first song at the end of the playlist)
+        next_index = self.play_order.next(current_index.get())
+        for _ in range(playlist.size() - 1):  # Songs that can't be played are skipped, unless none can
+            if next_index is None or not self.unplayable(playlist.get(next_index)):
+                break
+            next_index = self.play_order.next(next_index)
+        if next_index is None:
+            return  # The playlist is empty
         playlist.select_clear(0, "end")
         playlist.select_set(next_index)
+        playlist.see(next_index)  # Scroll the playlist to the song
         current_index.set(next_index)
         
        
@@ -1046,16 +1570,23 @@ class MusicPlayerScreen(BaseScreen):
 
     # Method to play the previous song in the playlist
     def previous_song(self, playlist, current_index):
-        mixer.music.stop()  # Stop the current song
+        self.engine.stop()  # Stop the current song
         self.elapsed_time = 0
         self.paused_time = 0
         self.is_playing = False
 
 
-        # Move to the previous song (loop back to the last song if at the start)
-        prev_index = (current_index.get() - 1) % playlist.size()
+        # Move back to the previously played song (or the previous one in the playlist)
+        prev_index = self.play_order.previous(current_index.get())
+        for _ in range(playlist.size() - 1):  # Songs that can't be played are skipped, unless none can
+            if prev_index is None or not self.unplayable(playlist.get(prev_index)):
+                break
+            prev_index = self.play_order.previous(prev_index)
+        if prev_index is None:
+            return  # The playlist is empty
         playlist.select_clear(0, "end")
         playlist.select_set(prev_index)
+        playlist.see(prev_index)  # Scroll the playlist to the song
         current_index.set(prev_index)
 
         
@@ -1070,26 +1601,31 @@ class MusicPlayerScreen(BaseScreen):
 
         self.elapsed_time = value  # Set the current elapsed time to the new seek bar value
         formatted_time = time.strftime('%M:%S', time.gmtime(self.elapsed_time))  # Format the time into minutes:seconds
-        self.duration_label.configure(text=f"{formatted_time}")  # Update the displayed time
+        self.set_label_text(self.duration_label, formatted_time)  # Update the displayed time
         self.seek_bar.set(self.elapsed_time)  # Update the seek bar position
 
 
     # Method to handle when the user releases the seek bar (finishes seeking).
     def on_seek_bar_release(self, value):
+        span = instrumentation.start("seek_release_to_playback")
         self.paused_time = value  # Set the paused time to the current seek bar position
         self.elapsed_time = self.paused_time  # Update the elapsed time to reflect the seek position
-        mixer.music.play(start=self.paused_time)  # Play the song from the new position
+        self.engine.seek(self.paused_time)  # Move inside the open stream, a paused song stays paused
+        if self.is_paused:
+            instrumentation.end(span)  # Nothing to hear, the seek itself is measured
+        else:
+            self.end_when_audible(span)
         
         self.last_update_time = time.time()  # Store the current time for time calculations
         self.is_seeking = False   # Mark that the seeking process has ended
         
 
-        # If the song was paused, resume playback.
+        # If the song was paused, it stays paused at the new position.
         if self.is_paused:
-            mixer.music.pause()  # Pause the music (in case the user was not playing)
+            self.clock.stop()
             self.is_playing = False   # Show that the song is not playing
         else:
-            self.play_time(self.song_status, self.playlist_listbox, self.current_index)  # Continue tracking playback time
+            self.clock.start()  # Continue tracking playback time
 
     
     # Method to display error messages in a pop-up window.
@@ -1102,54 +1638,2812 @@ class MusicPlayerScreen(BaseScreen):
         ok_button.pack(pady=5)  # Add padding around the button
 
 
-# Set the working directory to the specified project path.
-os.chdir(r"C:\Users\adiso\OneDrive\Documents\Coding\Python\Proj")
-script_dir = os.path.dirname(__file__)  # Get the current directory
-login_state_path = os.path.join(script_dir, "login_state.pkl")  # Define the path for login state file
+# PlayOrder: Order in which the playlist's songs are played, the playlist itself is never reordered.
+# Shuffle is an array-backed permutation filled in by an on-demand Fisher-Yates, previous walks a bounded history.
+class PlayOrder:
+    def __init__(self, size=0, history_size=500):
+        self.size = size  # Number of songs in the playlist
+        self.shuffled = False
+        self.permutation = array("l")  # Shuffled playlist indexes, the first `drawn` ones are already played
+        self.drawn = 0
+        self.upcoming = None  # Shuffled song drawn ahead of time by peek_next
+        self.history = deque(maxlen=history_size)  # Previously played songs
+        self.forward = deque(maxlen=history_size)  # Songs to replay after going back
+
+
+    def reset(self, size=0):
+        # Starts over for a new playlist.
+        self.size = 0
+        self.permutation = array("l")
+        self.drawn = 0
+        self.upcoming = None
+        self.history.clear()
+        self.forward.clear()
+        self.resize(size)
+
+
+    def resize(self, size):
+        # Songs were added at the end of the playlist, they join the songs not drawn yet.
+        if self.shuffled:
+            self.permutation.extend(range(self.size, size))
+        self.size = size
+
+
+    def remove(self, mapping, size):
+        # Songs were removed from the playlist, mapping gives the new index of every old one (-1 if it was removed).
+        if self.shuffled:
+            drawn = [mapping[i] for i in self.permutation[:self.drawn] if mapping[i] >= 0]
+            self.permutation = array("l", drawn + [mapping[i] for i in self.permutation[self.drawn:] if mapping[i] >= 0])
+            self.drawn = len(drawn)
+        self.history = deque((mapping[i] for i in self.history if mapping[i] >= 0), maxlen=self.history.maxlen)
+        self.forward = deque((mapping[i] for i in self.forward if mapping[i] >= 0), maxlen=self.forward.maxlen)
+        if self.upcoming is not None and mapping[self.upcoming] < 0:
+            self.upcoming = None
+        elif self.upcoming is not None:
+            self.upcoming = mapping[self.upcoming]
+        self.size = size
+
+
+    def set_shuffle(self, shuffled, current):
+        self.shuffled = shuffled
+        self.upcoming = None
+        self.forward.clear()  # Going forward follows the new order
+        if shuffled:
+            self.permutation = array("l", range(self.size))
+            self.drawn = 0
+            if 0 <= current < self.size:
+                self.take(current)  # The current song counts as played
+
+
+    def take(self, index):
+        # Swaps a song into the next drawn slot of the permutation.
+        position = self.permutation.index(index, self.drawn)
+        self.permutation[self.drawn], self.permutation[position] = index, self.permutation[self.drawn]
+        self.drawn += 1
+
+
+    def draw(self):
+        # One Fisher-Yates step: picks a random song among the ones not played yet in this round.
+        if self.drawn >= self.size:
+            self.drawn = 0  # Every song was played, start a new round
+        self.take(self.permutation[random.randrange(self.drawn, self.size)])
+        return self.permutation[self.drawn - 1]
+
+
+    def peek_next(self, current):
+        # Returns the song that next() will return, without moving (used to queue it for gapless playback).
+        if self.size == 0:
+            return None
+        if self.forward:
+            return self.forward[-1]
+        if not self.shuffled:
+            return (current + 1) % self.size
+        if self.upcoming is None:
+            self.upcoming = self.draw()
+        return self.upcoming
+
+
+    def next(self, current):
+        index = self.peek_next(current)
+        if index is None:
+            return None
+        self.history.append(current)
+        if self.forward:
+            self.forward.pop()
+        else:
+            self.upcoming = None
+        return index
+
+
+    def previous(self, current):
+        if self.history:
+            self.forward.append(current)
+            return self.history.pop()
+        if not self.shuffled:
+            return (current - 1) % self.size if self.size else None
+        return current  # Nothing was played before, restart the song
+
+
+    def jump(self, current, index):
+        # The user picked a song directly.
+        self.history.append(current)
+        self.forward.clear()
+        if index == self.upcoming:
+            self.upcoming = None  # Already drawn, it must not be drawn again as the next song
+        elif self.shuffled:
+            try:
+                self.take(index)  # Don't draw it again in this round
+            except ValueError:
+                pass  # Already played in this round
+
+
+# TrackTable: Songs of the playlist, referred to by integer id, stored column by column in arrays.
+# Folders are interned and file names are packed into one bytearray, so a song costs about 30 bytes plus its name.
+class TrackTable:
+    def __init__(self):
+        self.folders = []  # Absolute folder paths, interned
+        self.folder_ids = {}  # folder path -> index in folders
+        self.labels = []  # Folder shown in the playlist, relative to the directory it was loaded from
+        self.folder = array("I")  # Folder of each song
+        self.name_data = bytearray()  # File names, encoded with os.fsencode
+        self.name_start = array("I")  # Where each song's name starts in name_data
+        self.name_length = array("H")
+        self.size = array("q")  # File size and mtime when the song was found
+        self.mtime_ns = array("q")
+        self.duration = array("f")  # Seconds, NaN until the metadata service has parsed the song
+        self.format = bytearray()  # Index in format_names of the format detected from the magic bytes, 0 until then
+        self.format_names = [None]
+        self.live = bytearray()  # 0 once the song was removed, ids aren't reused
+        self.ids = {}  # (folder, encoded file name) -> id of the live song, for the folder watcher's lookups
+
+
+    def __len__(self):
+        return len(self.folder)
+
+
+    def intern(self, directory, subfolder):
+        # Returns the id of the folder, adding it on first use.
+        path = os.path.join(directory, subfolder) if subfolder else directory
+        folder = self.folder_ids.get(path)
+        if folder is None:
+            folder = self.folder_ids[path] = len(self.folders)
+            self.folders.append(path)
+            self.labels.append(subfolder)
+        return folder
+
+
+    def add(self, directory, entries):
+        # Adds (path relative to the directory, size, mtime_ns) entries, returns the range of their ids.
+        directory = os.path.abspath(directory)
+        first = len(self.folder)
+        subfolder, folder = None, None
+        for name, size, mtime_ns in entries:
+            head, name = os.path.split(name)
+            if head != subfolder:  # The scanner hands over one folder after the other
+                subfolder, folder = head, self.intern(directory, head)
+            encoded = os.fsencode(name)
+            self.ids[(folder, encoded)] = len(self.folder)
+            self.folder.append(folder)
+            self.name_start.append(len(self.name_data))
+            self.name_length.append(len(encoded))
+            self.name_data += encoded
+            self.size.append(size)
+            self.mtime_ns.append(mtime_ns)
+        count = len(self.folder) - first
+        self.duration.extend(array("f", [math.nan]) * count)
+        self.format.extend(bytes(count))
+        self.live.extend(b"\x01" * count)
+        return range(first, first + count)
+
+
+    def name(self, track):
+        # File name of the song.
+        start = self.name_start[track]
+        return os.fsdecode(bytes(self.name_data[start:start + self.name_length[track]]))
+
+
+    def path(self, track):
+        return os.path.join(self.folders[self.folder[track]], self.name(track))
+
+
+    def label(self, track):
+        # Path of the song relative to the directory it was loaded from, as shown in the playlist.
+        subfolder = self.labels[self.folder[track]]
+        return os.path.join(subfolder, self.name(track)) if subfolder else self.name(track)
+
+
+    def rename(self, track, directory, name):
+        # Moves the song to a new path relative to the directory, the old name's bytes are left unused.
+        head, name = os.path.split(name)
+        encoded = os.fsencode(name)
+        self.forget(track)
+        self.folder[track] = self.intern(os.path.abspath(directory), head)
+        self.name_start[track] = len(self.name_data)
+        self.name_length[track] = len(encoded)
+        self.name_data += encoded
+        self.ids[(self.folder[track], encoded)] = track
+
+
+    def remove(self, track):
+        self.forget(track)
+        self.live[track] = 0
+
+
+    def forget(self, track):
+        # Takes the song's current path out of the lookup.
+        start = self.name_start[track]
+        key = (self.folder[track], bytes(self.name_data[start:start + self.name_length[track]]))
+        if self.ids.get(key) == track:
+            del self.ids[key]
+
+
+    def set_duration(self, track, seconds):
+        self.duration[track] = seconds
+
+
+    def set_format(self, track, name):
+        if name not in self.format_names:
+            self.format_names.append(name)
+        self.format[track] = self.format_names.index(name)
+
+
+    def get_format(self, track):
+        # Returns the format name, or None if the song wasn't probed yet (or isn't a supported audio file).
+        return self.format_names[self.format[track]]
+
 
+    def get_duration(self, track):
+        # Returns the cached duration, or None if the song wasn't parsed yet.
+        duration = self.duration[track]
+        return None if math.isnan(duration) else duration
 
-# Function to load login state (whether the user should stay logged in).
-def load_login_state():
-    try:
-        print(f"Loading login state from: {login_state_path}")  # Print the login state file path
-        if os.path.exists(login_state_path):  # Check if the login state file exists
-            with open(login_state_path, "rb") as file:  # Open the file in binary read mode
-                login_state = pickle.load(file)  # Load the login state object
 
-            print(f"Loaded login state: {login_state}")  # Print the loaded login state
+    def find(self, directory, names):
+        # Returns {name: id} for the live songs among the given paths relative to a directory.
+        directory = os.path.abspath(directory)
+        found = {}
+        for name in names:
+            head, tail = os.path.split(name)
+            folder = self.folder_ids.get(os.path.join(directory, head) if head else directory)
+            track = self.ids.get((folder, os.fsencode(tail))) if folder is not None else None
+            if track is not None:
+                found[name] = track
+        return found
+
+
+# PlaybackEngine: Playback layer over pygame.mixer.music.
+# The loaded song stays open in the mixer, so resuming unpauses it and seeking moves inside the stream,
+# and the position comes from one monotonic clock instead of paused_time + get_pos().
+class PlaybackEngine:
+    HEAD_SECONDS = 2  # Audio copied on the Tk thread when a cached song starts past its beginning
+
+    def __init__(self, root):
+        self.root = root  # Tk root used to schedule the channel checks
+        self.initialized = False  # The mixer is started by the first song, not when the player opens
+        self.volume = None  # Volume set before the mixer was started
+        self.gain = 1.0  # Loudness correction of the current song, applied on top of the volume
+        self.end_events = False  # Whether the mixer posts MUSIC_END at the end of a song
+        self.path = None  # Song loaded in the mixer
+        self.format = None  # Its format as detected from its magic bytes, given to the mixer as the type of the file
+        self.queued_path = None  # Song queued for gapless playback
+        self.queued_format = None
+        self.paused = False
+        self.anchor_position = 0.0  # Song position in seconds at anchor_time
+        self.anchor_time = None  # time.monotonic() when the song last started moving, None while it isn't
+        self.last_position = 0  # Last mixer position, used to detect song changes without end events
+        self.frame_index = None  # Future with the Mp3FrameIndex of the open song
+        self.stream = None  # Mp3Slice loaded in the mixer after a seek through the frame index
+        self.cached = False  # Whether the song plays from the PCM cache on a channel instead of mixer.music
+        self.channel = None  # Channel reserved for songs from the PCM cache
+        self.sound = None  # Sound playing on the channel (it stops if it isn't referenced)
+        self.sound_end = 0.0  # Song position at which that sound ends
+        self.rest = None  # Future, then Sound, with the rest of the song after a sound that starts past its beginning
+        self.rest_end = 0.0  # Song position at which the rest ends
+        self.queued_sound = None  # Sound queued on the channel for gapless playback
+        self.watch_id = None  # Pending channel check
+        self.handed_over = False  # The channel ran out and mixer.music started the queued song, poll_end reports it
+
+
+    def init(self):
+        # Initializes the mixer and the end-of-song event used for gapless playback, on first use.
+        if self.initialized:
+            return
+        load_audio_stack()  # Usually already imported in the background
+        mixer.init()
+        mixer.set_reserved(1)  # Channel 0 is only used for cached songs
+        self.channel = mixer.Channel(0)
+        self.initialized = True
+        if self.volume is not None:
+            self.set_volume(self.volume)
+        try:
+            pygame.display.init()  # The mixer only posts its end event when the event system is up, no window is opened
+            mixer.music.set_endevent(MUSIC_END)
+            self.end_events = True
+        except pygame.error as e:
+            print(f"End-of-song events unavailable, falling back to polling: {e}")
+
+
+    def set_volume(self, volume):
+        self.volume = volume
+        if self.initialized:
+            level = min(volume * self.gain, 1.0)  # The mixer can't go louder than full volume
+            mixer.music.set_volume(level)
+            self.channel.set_volume(level)
+
+
+    def set_gain(self, gain):
+        # Sets the loudness correction of the song that plays next.
+        self.gain = gain
+        if self.volume is not None:
+            self.set_volume(self.volume)
+
+
+    def audible(self):
+        # Whether the mixer is playing and has started mixing the song.
+        if self.cached:
+            return self.channel.get_busy()
+        return self.initialized and mixer.music.get_busy() and mixer.music.get_pos() > 0
+
+
+    def set_anchor(self, position, moving):
+        self.anchor_position = position
+        self.anchor_time = time.monotonic() if moving else None
+
+
+    def position(self):
+        # Current position in the song, in seconds.
+        if self.anchor_time is None:
+            return self.anchor_position
+        return self.anchor_position + time.monotonic() - self.anchor_time
+
+
+    def play(self, path, start=0.0, song_format=None):
+        # Plays a song from the given position, the file is only loaded if it isn't the one already open.
+        # Songs in the PCM cache start right away on the channel, others are decoded in the background for next time.
+        self.init()
+        self.stop()
+        self.format = song_format
+        track = pcm_cache.get(path)
+        if track is not None:
+            self.play_cached(path, track, start)
+            return
+        pcm_cache.request(path)
+
+        if path != self.path:
+            self.frame_index = metadata_service.fetch_frame_index(path) if song_format == "mp3" else None
+        if start > 0:
+            position = self.load_at(path, start)  # Jump straight to the frame when the index is ready
+            if position is not None:
+                self.set_anchor(position, True)
+                return
+
+        if path != self.path or self.stream is not None or self.cached:
+            self.path = None  # Nothing is open if loading fails
+            mixer.music.load(path, self.format or "")  # The detected format, a mislabeled file gets the right decoder
+            self.path = path
+            self.cached = False
+            self.close_stream(None)
+        mixer.music.play(start=start)
+        self.set_anchor(start, True)
+
+
+    def play_cached(self, path, track, start):
+        # Plays a decoded song on the channel, nothing is read from disk.
+        self.path = path
+        self.cached = True
+        self.close_stream(None)
+        self.start_channel(track, start)
+
+
+    def start_channel(self, track, start):
+        # Starts the channel at a position. From the beginning the song's own Sound plays, nothing is copied.
+        # Past it only the next HEAD_SECONDS are copied here, the rest is copied on a worker thread and queued behind them.
+        first = track.frame_at(start)
+        self.rest = None
+        if first == 0:
+            self.sound = track.sound
+            self.sound_end = track.duration()
+        else:
+            split = first + self.HEAD_SECONDS * track.frequency
+            self.sound = track.cut(first, split)
+            self.sound_end = min(split, track.frames) / track.frequency
+            if split < track.frames:
+                self.rest = pcm_cache.cutter.submit(track.cut, split)
+                self.rest_end = track.duration()
+        self.channel.play(self.sound)
+        if self.queued_sound is not None and self.rest is None:
+            self.channel.queue(self.queued_sound)
+        self.set_anchor(first / track.frequency, True)  # The start of the sample frame it begins with
+        self.schedule_watch()
+
+
+    def load_at(self, path, position):
+        # Loads the song from the MP3 frame at the position and returns that frame's exact time,
+        # or returns None if the frame index isn't available (yet).
+        if self.frame_index is None or not self.frame_index.done() or self.frame_index.exception():
+            return None
+        index = self.frame_index.result()
+        if index is None:
+            return None
+
+        offset, position = index.locate(position)
+        stream = Mp3Slice(path, offset)
+        mixer.music.load(stream, "mp3")  # The decoder starts at the frame, nothing before it is read
+        self.path = path
+        self.cached = False
+        self.close_stream(stream)
+        mixer.music.play()
+        if self.queued_path is not None:
+            mixer.music.queue(self.queued_path, self.queued_format or "")  # Keep the next song queued
+        self.clear_end_events()
+        self.last_position = 0
+        return position
+
+
+    def close_stream(self, stream):
+        # Replaces the stream loaded in the mixer, closing the previous one.
+        if self.stream is not None:
+            self.stream.close()
+        self.stream = stream
+
+
+    def stop(self):
+        if self.initialized:
+            mixer.music.stop()  # Also drops the queued song
+            self.channel.stop()
+        self.sound = self.queued_sound = self.rest = None
+        self.handed_over = False
+        self.cancel_watch()
+        self.clear_end_events()  # Stopping the mixer posts an end event, it isn't a finished song
+        self.queued_path = None
+        self.paused = False
+        self.last_position = 0
+        self.set_anchor(0.0, False)
+
+
+    def pause(self):
+        if self.cached:
+            self.channel.pause()
+            self.cancel_watch()
+        else:
+            mixer.music.pause()
+        self.paused = True
+        self.set_anchor(self.position(), False)
 
 
-            # Validate if the loaded login state is a dictionary.
-            if isinstance(login_state, dict):
-                stay_logged_in = login_state.get("stay_logged_in", False)  # Get the 'stay_logged_in' status (False)
-                username = login_state.get("username", "User")  # Get the username as "User"
+    def resume(self):
+        if self.cached:
+            self.channel.unpause()
+        else:
+            mixer.music.unpause()  # The decoder continues where it stopped, nothing is reloaded
+        self.paused = False
+        self.set_anchor(self.anchor_position, True)
+        self.schedule_watch()
+
+
+    def seek(self, position):
+        # Moves inside the open stream, MP3s jump straight to the frame at the position through their frame index,
+        # other formats use set_pos and only restart the decoder where it isn't supported.
+        # Cached songs restart the channel at the sample, or are loaded again if they were evicted meanwhile.
+        if self.path is None:
+            return  # Nothing is open, the mixer may not even be loaded yet
+        if self.cached:
+            paused = self.paused
+            track = pcm_cache.get(self.path)
+            if track is None:
+                self.play(self.path, position, self.format)
             else:
-                raise ValueError("Invalid login state format")  # Raise an error if the format is invalid
-            
-            return stay_logged_in, username   # Return the login state information
+                self.start_channel(track, position)
+            if paused:
+                self.pause()
+            return
+
+        exact_position = self.load_at(self.path, position)
+        if exact_position is not None:
+            if self.paused:
+                mixer.music.pause()
+            self.set_anchor(exact_position, not self.paused)
+            return
+
+        try:
+            mixer.music.set_pos(position)
+        except pygame.error:
+            mixer.music.play(start=position)
+            self.clear_end_events()
+            self.last_position = 0
+            if self.paused:
+                mixer.music.pause()
+        self.set_anchor(position, not self.paused)
+
+
+    def queue(self, path, song_format=None):
+        # Queues the song that follows the current one. A cached song queues the next one on its channel if it's
+        # decoded. Otherwise the next song is requested and loaded in mixer.music, which starts it when the channel
+        # runs out, unless it's decoded by then.
+        self.init()
+        if self.cached:
+            self.queued_sound = None
+            track = pcm_cache.get(path)
+            if track is not None and track.sound is not self.sound:  # The same Sound twice in a row can't tell when the second one starts
+                self.queued_sound = track.sound
+                if self.rest is None:
+                    self.channel.queue(self.queued_sound)  # Otherwise it's queued once the rest of the current song plays
+            else:
+                pcm_cache.request(path)
+                mixer.music.load(path, song_format or "")  # Opened now, so starting it is quick
+        else:
+            mixer.music.queue(path, song_format or "")
+            pcm_cache.request(path)  # Upcoming song
+        self.queued_path = path
+        self.queued_format = song_format
+        self.schedule_watch()
+
+
+    def rename(self, old, new):
+        # Follows a song that was renamed on disk, so seeking and the switch to the queued song use its new path.
+        if self.path == old:
+            self.path = new
+        if self.queued_path == old:
+            self.queued_path = new
+
+
+    def set_format(self, path, song_format):
+        # Records the format of a song that was started or queued before it was probed,
+        # an open MP3 gets its frame index for seeking.
+        if path == self.queued_path and self.queued_format is None:
+            self.queued_format = song_format
+        if path == self.path and self.format is None:
+            self.format = song_format
+            if song_format == "mp3" and self.frame_index is None:
+                self.frame_index = metadata_service.fetch_frame_index(path)
+
+
+    def poll_end(self):
+        # Returns "queued" if the mixer moved on to the queued song, "finished" if it ran out of songs, otherwise None.
+        if self.cached:
+            self.check_channel()
+        if self.handed_over:
+            self.handed_over = False  # The channel check already moved on to mixer.music
+            return "queued"
+        if self.cached:
+            if self.queued_sound is not None and self.rest is None and self.channel.get_sound() is self.queued_sound:
+                overshoot = max(self.position() - self.sound_end, 0.0)  # The clock notices the switch a little late
+                self.sound, self.queued_sound = self.queued_sound, None
+                self.path, self.queued_path = self.queued_path, None
+                self.format = self.queued_format
+                self.sound_end = self.sound.get_length()
+                self.set_anchor(overshoot, True)
+                return "queued"
+            if self.channel.get_busy() or self.rest is not None:
+                return None
+            self.set_anchor(self.position(), False)
+            return "finished"
+
+        if self.end_events:
+            ended = bool(pygame.event.get(MUSIC_END))  # Posted by the mixer at the end of the stream
+        else:
+            # Without end events: the mixer restarts its position when the queued song starts, or goes idle at the end
+            position = mixer.music.get_pos()
+            ended = (self.queued_path is not None and position < self.last_position) or not mixer.music.get_busy()
+            self.last_position = position
+
+        if not ended:
+            return None
+        if self.queued_path is not None:
+            self.path, self.queued_path = self.queued_path, None
+            self.format = self.queued_format
+            self.frame_index = metadata_service.fetch_frame_index(self.path) if self.format == "mp3" else None
+            self.close_stream(None)  # The mixer released the previous song
+            self.last_position = 0
+            self.set_anchor(max(mixer.music.get_pos(), 0) / 1000, True)  # get_pos restarts with the queued song
+            return "queued"
+        self.set_anchor(self.position(), False)
+        return "finished"
+
+
+    def clear_end_events(self):
+        if self.end_events:
+            pygame.event.clear(MUSIC_END)
+
+
+    def check_channel(self):
+        # Tk thread: queues the rest of the song once it's copied, and the queued song once the rest plays
+        # or once it's decoded. If the channel runs out before the queued song is decoded, mixer.music starts it.
+        if isinstance(self.rest, Future):
+            if not self.rest.done():
+                return
+            try:
+                self.rest = self.rest.result()
+            except Exception as e:
+                print(f"Error preparing the rest of {self.path}: {e}")
+                self.rest = None  # The song ends after the part that plays
+                return
+            if self.channel.get_busy():
+                self.channel.queue(self.rest)
+            else:
+                self.channel.play(self.rest)  # The part before it already ran out
+        if self.rest is not None and self.channel.get_sound() is self.rest:
+            self.sound, self.rest = self.rest, None
+            self.sound_end = self.rest_end
+            if self.queued_sound is not None:
+                self.channel.queue(self.queued_sound)
+        if self.queued_path is None or self.queued_sound is not None or self.rest is not None:
+            return
+        if self.channel.get_busy():
+            track = pcm_cache.get(self.queued_path) if pcm_cache.ready(self.queued_path) else None
+            if track is not None and track.sound is not self.sound:
+                self.queued_sound = track.sound
+                self.channel.queue(self.queued_sound)
+            return
+        mixer.music.play()  # Loaded by queue()
+        self.path, self.queued_path = self.queued_path, None
+        self.format = self.queued_format
+        self.cached = False
+        self.sound = None
+        self.frame_index = metadata_service.fetch_frame_index(self.path) if self.format == "mp3" else None
+        self.clear_end_events()
+        self.last_position = 0
+        self.set_anchor(0.0, True)
+        self.handed_over = True
+
+
+    def schedule_watch(self):
+        # Checks the channel again while the rest of the song or a song that isn't decoded yet has to follow,
+        # independently of the clock tick, which is slower while the window is minimized: every 5 ms while the rest
+        # is copied, then at least every second (the queued song may be decoded) and every 5 ms shortly before the end.
+        self.cancel_watch()
+        if not self.cached or self.paused:
+            return
+        if self.rest is None and (self.queued_path is None or self.queued_sound is not None):
+            return  # The channel plays the queued song by itself
+        remaining = self.sound_end - self.position()
+        delay = 5 if isinstance(self.rest, Future) or remaining < 0.2 else int(min(remaining - 0.2, 1.0) * 1000)
+        self.watch_id = self.root.after(delay, self.watch)
+
+
+    def watch(self):
+        self.watch_id = None
+        self.check_channel()
+        self.schedule_watch()
+
+
+    def cancel_watch(self):
+        if self.watch_id is not None:
+            self.root.after_cancel(self.watch_id)
+            self.watch_id = None
+
+
+# PcmTrack: A song decoded to the mixer's sample format. Its Sound plays the song from the beginning as it is,
+# a part of it is copied into a new Sound to start elsewhere, without reading the file.
+class PcmTrack:
+    def __init__(self, sound, frequency, key):
+        self.sound = sound  # The whole song
+        self.samples = memoryview(sound)  # Its samples, one row per sample frame, not a copy
+        self.frames = len(self.samples)  # Sample frames of the song
+        self.size = self.samples.nbytes
+        self.frequency = frequency  # Sample frames per second
+        self.key = key  # (size, mtime_ns) of the file it was decoded from
+
+
+    def duration(self):
+        return self.frames / self.frequency
+
+
+    def frame_at(self, position):
+        # Sample frame at a position in seconds.
+        return min(max(int(position * self.frequency), 0), self.frames - 1)
+
+
+    def cut(self, first, last=None):
+        # Returns a new Sound with the sample frames from first up to last, the mixer copies them.
+        return mixer.Sound(buffer=self.samples[first:last])
+
+
+# PcmCache: Decoded songs kept in memory, so replaying, going back or seeking in a recent song starts at once.
+# Songs are decoded on a worker thread when they're played or queued, the least recently used are evicted
+# when the decoded bytes go over the budget.
+class PcmCache:
+    def __init__(self, budget):
+        self.budget = budget  # Bytes of decoded audio kept, 0 turns the cache off
+        self.tracks = OrderedDict()  # path -> PcmTrack, least recently used first
+        self.used = 0  # Bytes held by the tracks
+        self.pending = set()  # Paths being decoded
+        self.refused = {}  # path -> (size, mtime_ns) of songs too long for the budget or that can't be decoded
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pcm-decode")
+        self.cutter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pcm-cut")  # Copies parts of cached songs
+
+
+    def get(self, path):
+        # Returns the decoded song if it's cached and the file hasn't changed, otherwise None.
+        with self.lock:
+            track = self.tracks.get(path)
+        if track is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            if track.key != (stat.st_size, stat.st_mtime_ns):
+                self.remove(path)
+                return None
+            if path in self.tracks:
+                self.tracks.move_to_end(path)
+        return track
+
+
+    def ready(self, path):
+        # Whether the song is cached, without checking the file.
+        with self.lock:
+            return path in self.tracks
+
+
+    def request(self, path):
+        # Decodes the song in the background, unless it's cached or being decoded already.
+        if self.budget <= 0:
+            return
+        with self.lock:
+            if path in self.tracks or path in self.pending:
+                return
+            self.pending.add(path)
+        self.executor.submit(self.decode, path)
+
+
+    def decode(self, path):
+        # Worker thread. Songs whose known duration wouldn't fit in the budget aren't decoded, songs that turned out
+        # too long or failed to decode are remembered, so they aren't tried again until the file changes.
+        track = key = None
+        try:
+            frequency, sample_format, channels = mixer.get_init()
+            frame_size = abs(sample_format) // 8 * channels
+            stat = os.stat(path)
+            key = (stat.st_size, stat.st_mtime_ns)
+            metadata = metadata_service.peek(path)  # Cached duration, the file isn't parsed here
+            too_long = metadata is not None and (metadata["duration"] or 0) * frequency * frame_size > self.budget
+            if self.refused.get(path) != key and not too_long:
+                track = PcmTrack(mixer.Sound(file=path), frequency, key)  # Samples in the mixer's format, ready to play
+        except Exception as e:
+            print(f"Error decoding {path}: {e}")
+        with self.lock:
+            self.pending.discard(path)
+            if track is None or track.size > self.budget:
+                if key is not None:
+                    self.refused[path] = key
+                return
+            self.remove(path)
+            self.tracks[path] = track
+            self.used += track.size
+            while self.used > self.budget:
+                evicted = self.tracks.popitem(last=False)[1]
+                self.used -= evicted.size
+
+
+    def remove(self, path):
+        # Called with the lock held.
+        track = self.tracks.pop(path, None)
+        if track is not None:
+            self.used -= track.size
+
+
+# PlaybackClock: Owns the single scheduled tick that updates the playback time.
+# Starting it again cancels the pending tick, so plays, resumes and seeks never stack timers.
+class PlaybackClock:
+    def __init__(self, root, on_tick, interval=250, minimized_interval=2000):
+        self.root = root
+        self.on_tick = on_tick  # Returns False to stop ticking
+        self.interval = interval  # Milliseconds between ticks while the window is visible
+        self.minimized_interval = minimized_interval  # Coarser ticks while nobody can see the window
+        self.after_id = None
+
+
+    def start(self):
+        # (Re)starts the clock with an immediate tick.
+        self.stop()
+        self.after_id = self.root.after(0, self.tick)
+
+
+    def stop(self):
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
+
+
+    def running(self):
+        return self.after_id is not None
+
+
+    def tick(self):
+        self.after_id = None
+        keep_running = self.on_tick()
+        if keep_running and self.after_id is None:  # on_tick may have restarted the clock itself
+            visible = self.root.state() not in ("iconic", "withdrawn")
+            self.after_id = self.root.after(self.interval if visible else self.minimized_interval, self.tick)
+
+
+# Instrumentation: Timing spans of the actions users feel (click to audio, resume, seek, folder load).
+# Each span name keeps a histogram of its recent durations, and every span goes into a bounded log for Chrome traces.
+# While it's off, start() returns None and end() returns right away, so instrumented code pays one call.
+class Instrumentation:
+    def __init__(self, enabled=False, samples=4096, events=20000):
+        self.enabled = enabled
+        self.samples = samples  # Durations kept per span name
+        self.histograms = {}  # Span name -> [count, recent durations in ms]
+        self.events = deque(maxlen=events)  # (name, start, duration, thread id, args)
+        self.origin = time.perf_counter()  # Trace timestamps are relative to it
+        self.lock = threading.Lock()
+
+
+    def start(self, name, **args):
+        if not self.enabled:
+            return None
+        return [name, time.perf_counter(), args]
+
+
+    def end(self, span, **args):
+        if span is None:
+            return
+        name, start, span_args = span
+        span_args.update(args)
+        self.record(name, start, (time.perf_counter() - start) * 1000, span_args)
+
+
+    def record(self, name, start, milliseconds, args=None):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0, deque(maxlen=self.samples)]
+            histogram[0] += 1
+            histogram[1].append(milliseconds)
+            self.events.append((name, start, milliseconds, threading.get_ident(), args or {}))
+
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.events.clear()
+
+
+    def summary(self):
+        # Count, p50, p95, p99 and max (in ms) of each span name.
+        with self.lock:
+            snapshot = {name: (count, sorted(durations)) for name, (count, durations) in self.histograms.items()}
+        summary = {}
+        for name, (count, durations) in sorted(snapshot.items()):
+            def percentile(p):
+                return durations[max(0, -(-len(durations) * p // 100) - 1)]  # Nearest rank
+            summary[name] = {"count": count, "p50": percentile(50), "p95": percentile(95),
+                             "p99": percentile(99), "max": durations[-1]}
+        return summary
+
+
+    def dump_json(self, path):
+        with open(path, "w") as file:
+            json.dump({"spans": self.summary()}, file, indent=2)
+
+
+    def dump_chrome_trace(self, path):
+        # Writes the logged spans in the Trace Event format (chrome://tracing, Perfetto).
+        with self.lock:
+            events = list(self.events)
+        trace = [{"name": name, "cat": "ultra", "ph": "X", "pid": os.getpid(), "tid": thread,
+                  "ts": (start - self.origin) * 1e6, "dur": milliseconds * 1000, "args": args}
+                 for name, start, milliseconds, thread, args in events]
+        with open(path, "w") as file:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, file)
+
+
+# DebugPanel: Hidden window with the instrumentation histograms, opened and closed with Ctrl+Shift+D.
+class DebugPanel:
+    def __init__(self, root):
+        self.root = root
+        self.window = None
+        self.refresh_id = None
+
+
+    def toggle(self):
+        if self.window is not None:
+            self.close()
+            return
+        self.window = Toplevel(self.root)
+        self.window.title("Ultra timings")
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+
+        self.recording = IntVar(value=int(instrumentation.enabled))
+        Checkbutton(self.window, text="Record timings", variable=self.recording, command=self.toggle_recording).pack(anchor="w", padx=10, pady=5)
+        if lag_monitor is not None:
+            self.logging_stalls = IntVar(value=int(lag_monitor.running()))
+            Checkbutton(self.window, text=f"Log UI stalls to {lag_monitor.log_path}", variable=self.logging_stalls,
+                        command=self.toggle_stall_logging).pack(anchor="w", padx=10)
+        self.text = Text(self.window, width=76, height=12, font=("Courier", 10))
+        self.text.pack(padx=10)
+        buttons = Frame(self.window)
+        buttons.pack(pady=5)
+        Button(buttons, text="Save JSON", command=self.save_json).pack(side="left", padx=5)
+        Button(buttons, text="Save Chrome trace", command=self.save_trace).pack(side="left", padx=5)
+        Button(buttons, text="Reset", command=instrumentation.reset).pack(side="left", padx=5)
+        self.profile_button = Button(buttons, text="", command=self.toggle_profiling)
+        self.profile_button.pack(side="left", padx=5)
+        self.refresh()
+
+
+    def toggle_profiling(self):
+        session_profiler.toggle()
+        self.refresh_profile_button()
+
+
+    def refresh_profile_button(self):
+        self.profile_button.configure(text="Stop profiling" if session_profiler.running() else "Start profiling")
+
+
+    def toggle_recording(self):
+        instrumentation.enabled = bool(self.recording.get())
+
+
+    def toggle_stall_logging(self):
+        if self.logging_stalls.get():
+            lag_monitor.start()
+        else:
+            lag_monitor.stop()
+
+
+    def refresh(self):
+        lines = [f"{'span':<26}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        for name, stats in instrumentation.summary().items():
+            lines.append(f"{name:<26}{stats['count']:>8}{stats['p50']:>10.1f}{stats['p95']:>10.1f}{stats['p99']:>10.1f}{stats['max']:>10.1f}")
+        if not instrumentation.enabled:
+            lines.append("\nRecording is off.")
+        if session_profiler.last_path:
+            lines.append(f"\nLast profile: {session_profiler.last_path}")
+        self.refresh_profile_button()
+        self.text.delete("1.0", "end")
+        self.text.insert("1.0", "\n".join(lines))
+        self.refresh_id = self.root.after(1000, self.refresh)
+
+
+    def save_json(self):
+        path = filedialog.asksaveasfilename(parent=self.window, defaultextension=".json", initialfile="ultra-timings.json")
+        if path:
+            instrumentation.dump_json(path)
+
+
+    def save_trace(self):
+        path = filedialog.asksaveasfilename(parent=self.window, defaultextension=".json", initialfile="ultra-trace.json")
+        if path:
+            instrumentation.dump_chrome_trace(path)
+
+
+    def close(self):
+        if self.refresh_id is not None:
+            self.root.after_cancel(self.refresh_id)
+            self.refresh_id = None
+        if self.window is not None:
+            self.window.destroy()
+            self.window = None
+
+
+# LagMonitor: Watches the Tk event loop for stalls, turned on with ULTRA_LAG_MONITOR=1 or from the timing panel.
+# A heartbeat scheduled with root.after measures how late it fires, and a watchdog thread notices when it
+# doesn't fire at all, then logs the stack of the Tk thread and the screen method it's stuck in.
+# While no song plays and there was no input for a few seconds, both stop until the next key or mouse press,
+# so an idle window doesn't wake up at all.
+class LagMonitor:
+    def __init__(self, root, log_path, interval=100, idle_timeout=5, threshold=250, busy=None):
+        self.root = root
+        self.log_path = log_path  # Stall reports are appended to this file
+        self.interval = interval  # Heartbeat period in ms
+        self.idle_timeout = idle_timeout  # Seconds without input after which an idle player stops the heartbeat
+        self.busy = busy  # Returns whether a song plays or the timings are watched, None counts as always busy
+        self.threshold = threshold  # Lag in ms that counts as a stall
+        self.main_thread_id = threading.main_thread().ident  # The Tk loop runs on the main thread
+        self.last_beat = time.monotonic()
+        self.last_input = time.monotonic()
+        self.expected = None  # When the next heartbeat should fire
+        self.reported = False  # The current stall was already logged by the watchdog
+        self.awake = threading.Event()  # Set while the heartbeat runs, the watchdog waits for it
+        self.stop_event = None  # A new one for every start()
+        self.after_id = None
+        self.bound = False  # Input bindings are added once
+
+
+    def running(self):
+        return self.stop_event is not None and not self.stop_event.is_set()
+
+
+    def start(self):
+        if self.running():
+            return
+        self.stop_event = threading.Event()
+        self.awake.clear()
+        if not self.bound:
+            for sequence in ("<Any-KeyPress>", "<Any-ButtonPress>", "<MouseWheel>"):
+                self.root.bind_all(sequence, self.on_input, add="+")
+            self.bound = True
+        self.on_input()
+        threading.Thread(target=self.watch, args=(self.stop_event,), name="lag-monitor", daemon=True).start()
+
+
+    def stop(self):
+        if not self.running():
+            return
+        self.stop_event.set()
+        self.awake.set()  # Lets a waiting watchdog see the stop
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
+
+
+    def on_input(self, event=None):
+        # Key and mouse presses wake the heartbeat up.
+        self.last_input = time.monotonic()
+        if self.running() and not self.awake.is_set():
+            self.expected = None  # The time asleep isn't lag
+            self.heartbeat()
+
+
+    def heartbeat(self):
+        self.after_id = None
+        now = time.monotonic()
+        if self.expected is not None:
+            lag = (now - self.expected) * 1000
+            if instrumentation.enabled:
+                instrumentation.record("event_loop_lag", time.perf_counter(), lag)
+            if lag > self.threshold:
+                print(f"UI was blocked for {lag:.0f} ms")
+        self.last_beat = now
+        self.reported = False
+        if self.busy is not None and not self.busy() and now - self.last_input >= self.idle_timeout:
+            self.expected = None
+            self.awake.clear()  # Asleep until the next input
+            return
+        self.expected = now + self.interval / 1000
+        self.awake.set()
+        self.after_id = self.root.after(self.interval, self.heartbeat)
+
+
+    def watch(self, stop_event):
+        # Runs on its own thread, so it still runs while the Tk thread is stuck.
+        while True:
+            self.awake.wait()
+            if stop_event.wait(self.interval / 1000):
+                return
+            if not self.awake.is_set():
+                continue  # The heartbeat went to sleep meanwhile
+            lag = (time.monotonic() - self.last_beat) * 1000 - self.interval
+            if lag > self.threshold and not self.reported:
+                self.reported = True
+                self.report(lag)
+
+
+    def report(self, lag):
+        frame = sys._current_frames().get(self.main_thread_id)
+        if frame is None:
+            return
+        stack = "".join(traceback.format_stack(frame))
+        message = f"{datetime.now():%Y-%m-%d %H:%M:%S} UI stalled for {lag:.0f} ms in {self.screen_method(frame)}\n{stack}\n"
+        print(message)
+        try:
+            os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+            with open(self.log_path, "a") as file:
+                file.write(message)
+        except OSError as e:
+            print(f"Error writing stall report: {e}")
+
+
+    def screen_method(self, frame):
+        # Returns the innermost screen method on the stack, e.g. "MusicPlayerScreen.load".
+        while frame is not None:
+            screen = frame.f_locals.get("self")
+            if isinstance(screen, BaseScreen):
+                return f"{type(screen).__name__}.{frame.f_code.co_name}"
+            frame = frame.f_back
+        return "no screen method"
+
+
+# SessionProfiler: cProfile of the Tk thread, started and stopped with Ctrl+Shift+P or from the timing panel.
+# Each stopped session is written to a .prof file in the user data folder (open it with pstats or snakeviz).
+class SessionProfiler:
+    def __init__(self, directory):
+        self.directory = directory  # Where the profiles are written
+        self.profile = None  # Running profile
+        self.last_path = None  # File of the last profile
+
+
+    def running(self):
+        return self.profile is not None
+
+
+    def toggle(self):
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            print("Profiling started.")
+            return
+        self.profile.disable()
+        self.last_path = os.path.join(self.directory, f"profile-{datetime.now():%Y%m%d-%H%M%S}.prof")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self.profile.dump_stats(self.last_path)
+            print(f"Profile written to {self.last_path}")
+        except OSError as e:
+            print(f"Error writing profile: {e}")
+            self.last_path = None
+        self.profile = None
+
+
+# VirtualListView: Listbox replacement that only draws the visible rows of a backing list.
+# It keeps a fixed pool of canvas items, so memory and redraw time stay flat however many songs are loaded.
+class VirtualListView(Frame):
+    def __init__(self, master, width=60, height=15, font=None, bg="white", fg="black",
+                 selectbackground="#4169E1", selectforeground="white", formatter=str, on_activate=None, items=None):
+        super().__init__(master, bg=bg)
+        self.items = [] if items is None else items  # Backing list (or array), one entry per row
+        self.shown = None  # Sorted indices of the entries shown while the view is filtered, None shows every entry
+        self.selected = None  # Index of the selected row
+        self.formatter = formatter  # Turns an entry into the row's text
+        self.on_activate = on_activate  # Called with the row index on double-click or Enter
+        self.font = font or tkfont.nametofont("TkDefaultFont")
+        self.row_height = self.font.metrics("linespace") + 2
+        self.visible_rows = height
+        self.view_height = self.row_height * height
+        self.offset = 0  # Pixels scrolled from the top, allows smooth scrolling
+        self.colors = (bg, fg, selectbackground, selectforeground)
+        self.redraw_id = None
+
+
+        self.canvas = Canvas(self, width=self.font.measure("0") * width, height=self.view_height, bg=bg, highlightthickness=0, bd=0)
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.scrollbar = Scrollbar(self, orient="vertical", command=self.yview)
+        self.scrollbar.pack(side="right", fill="y")
+
+
+        # One background rectangle and text item per row that can be on screen, with the last drawn text and state
+        self.rows = []
+        for _ in range(height + 1):
+            rect = self.canvas.create_rectangle(0, 0, 0, 0, width=0, fill=bg)
+            text = self.canvas.create_text(4, 0, anchor="nw", font=self.font, fill=fg, text="")
+            self.rows.append([rect, text, None, None])
+
+
+        # Mouse and keyboard navigation
+        self.canvas.bind("<Configure>", lambda e: self.redraw())
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<Double-Button-1>", lambda e: self.activate(self.row_at(e.y)))
+        self.canvas.bind("<MouseWheel>", lambda e: self.scroll_to(self.offset - e.delta / 120 * 3 * self.row_height))
+        self.canvas.bind("<Button-4>", lambda e: self.scroll_to(self.offset - 3 * self.row_height))  # Linux wheel up
+        self.canvas.bind("<Button-5>", lambda e: self.scroll_to(self.offset + 3 * self.row_height))  # Linux wheel down
+        self.canvas.bind("<Up>", lambda e: self.move_selection(-1))
+        self.canvas.bind("<Down>", lambda e: self.move_selection(1))
+        self.canvas.bind("<Prior>", lambda e: self.move_selection(1 - self.visible_rows))
+        self.canvas.bind("<Next>", lambda e: self.move_selection(self.visible_rows - 1))
+        self.canvas.bind("<Home>", lambda e: self.move_selection(-len(self.items)))
+        self.canvas.bind("<End>", lambda e: self.move_selection(len(self.items)))
+        self.canvas.bind("<Return>", lambda e: self.activate(self.selected))
+
+
+    # Listbox-compatible methods used by the music player
+
+    def index(self, index):
+        # Converts "end" to a numeric index.
+        return len(self.items) if index == "end" else int(index)
+
+
+    def size(self):
+        return len(self.items)
+
+
+    def get(self, first, last=None):
+        # Returns one entry, or a tuple of entries when a range is given (like Listbox.get).
+        if last is None:
+            return self.items[self.index(first)]
+        last = len(self.items) - 1 if last == "end" else int(last)
+        return tuple(self.items[self.index(first):last + 1])
+
+
+    def insert(self, index, *elements):
+        index = self.index(index)
+        if self.shown is not None and index < len(self.items):
+            self.shown = [i + len(elements) if i >= index else i for i in self.shown]  # New entries stay hidden
+        if index < len(self.items):
+            tail = self.items[index:]
+            del self.items[index:]
+            self.items.extend(elements)
+            self.items.extend(tail)
+        else:
+            self.items.extend(elements)  # Songs are appended, the common case
+        if self.selected is not None and self.selected >= index:
+            self.selected += len(elements)  # Keep the same entry selected
+        self.schedule_redraw()
+
+
+    def delete(self, first, last=None):
+        first = self.index(first)
+        last = first if last is None else (len(self.items) - 1 if last == "end" else int(last))
+        del self.items[first:last + 1]
+        if self.shown is not None:
+            self.shown = [i if i < first else i - (last - first + 1) for i in self.shown if not first <= i <= last]
+        if self.selected is not None:
+            if first <= self.selected <= last:
+                self.selected = None
+            elif self.selected > last:
+                self.selected -= last - first + 1
+        self.scroll_to(self.offset)  # Clamp the scroll position to the new size
+
+
+    def remove(self, mapping):
+        # Drops the entries whose new index is -1 in the mapping (see removal_mapping) and renumbers the others.
+        kept = [item for item, new in zip(self.items, mapping) if new >= 0]
+        del self.items[:]
+        self.items.extend(kept)  # Keeps the type of the backing list
+        if self.selected is not None:
+            self.selected = mapping[self.selected] if mapping[self.selected] >= 0 else None
+        if self.shown is not None:
+            self.shown = [mapping[i] for i in self.shown if mapping[i] >= 0]
+        self.scroll_to(self.offset)
+
+
+    def select_set(self, index):
+        self.selected = self.index(index)
+        self.schedule_redraw()
+
+
+    def select_clear(self, first, last=None):
+        self.selected = None
+        self.schedule_redraw()
+
+
+    def curselection(self):
+        return () if self.selected is None else (self.selected,)
+
+
+    def see(self, index):
+        # Scrolls just enough to make the row visible, entries hidden by the filter are left alone.
+        row = self.row_of(self.index(index))
+        if row is None:
+            return
+        top = row * self.row_height
+        if top < self.offset:
+            self.scroll_to(top)
+        elif top + self.row_height > self.offset + self.view_height:
+            self.scroll_to(top + self.row_height - self.view_height)
+
+
+    def yview(self, *args):
+        # Scrollbar protocol: "moveto fraction" or "scroll n units|pages".
+        total = self.row_count() * self.row_height
+        if not args:
+            return (self.offset / total, (self.offset + self.view_height) / total) if total else (0.0, 1.0)
+        if args[0] == "moveto":
+            self.scroll_to(float(args[1]) * total)
+        elif args[0] == "scroll":
+            step = self.row_height if args[2] == "units" else self.row_height * (self.visible_rows - 1)
+            self.scroll_to(self.offset + int(args[1]) * step)
+
+
+    # Filtering
+
+    def set_filter(self, indices):
+        # Shows only the entries at the given sorted indices, None shows every entry again.
+        self.shown = indices
+        self.scroll_to(0)
+
+
+    def row_count(self):
+        return len(self.items) if self.shown is None else len(self.shown)
+
+
+    def entry_at(self, row):
+        # Index of the entry drawn in a row.
+        return row if self.shown is None else self.shown[row]
+
+
+    def row_of(self, index):
+        # Row of an entry, or None if the filter hides it.
+        if self.shown is None:
+            return index
+        row = bisect_left(self.shown, index)
+        return row if row < len(self.shown) and self.shown[row] == index else None
+
+
+    # Drawing and navigation
+
+    def scroll_to(self, offset):
+        max_offset = max(0, self.row_count() * self.row_height - self.view_height)
+        self.offset = int(min(max(offset, 0), max_offset))
+        self.schedule_redraw()
+
+
+    def schedule_redraw(self):
+        # Coalesces several changes into one redraw when Tk is idle.
+        if self.redraw_id is None:
+            self.redraw_id = self.after_idle(self.redraw)
+
+
+    def redraw(self):
+        # Moves the row pool to the scroll position and only reconfigures the rows whose text or state changed.
+        if self.redraw_id is not None:
+            self.after_cancel(self.redraw_id)
+            self.redraw_id = None
+        bg, fg, select_bg, select_fg = self.colors
+        width = self.canvas.winfo_width()
+        first, shift = divmod(self.offset, self.row_height)
+        count = self.row_count()
+
+        for slot, row in enumerate(self.rows):
+            y = slot * self.row_height - shift
+            self.canvas.coords(row[0], 0, y, width, y + self.row_height)
+            self.canvas.coords(row[1], 4, y + 1)
+
+            if first + slot < count:
+                index = self.entry_at(first + slot)
+                label, selected = self.formatter(self.items[index]), index == self.selected
+            else:
+                label, selected = "", False
+            if (label, selected) != (row[2], row[3]):
+                self.canvas.itemconfigure(row[0], fill=select_bg if selected else bg)
+                self.canvas.itemconfigure(row[1], text=label, fill=select_fg if selected else fg)
+                row[2], row[3] = label, selected
+
+        self.scrollbar.set(*self.yview())
+
+
+    def row_at(self, y):
+        # Returns the index of the entry under a y coordinate, or None below the last row.
+        row = int((self.offset + y) // self.row_height)
+        return self.entry_at(row) if row < self.row_count() else None
+
+
+    def on_click(self, event):
+        self.canvas.focus_set()  # Receive the keyboard navigation
+        index = self.row_at(event.y)
+        if index is not None:
+            self.select_set(index)
+
+
+    def move_selection(self, delta):
+        count = self.row_count()
+        if count == 0:
+            return
+        row = None if self.selected is None else self.row_of(self.selected)
+        row = 0 if row is None else min(max(row + delta, 0), count - 1)
+        self.select_set(self.entry_at(row))
+        self.see(self.entry_at(row))
+
+
+    def activate(self, index):
+        if index is not None and self.on_activate:
+            self.on_activate(index)
+
+
+# SearchIndex: Finds playlist entries by the words of their file names and tags, typed in any order.
+# Terms of three or more characters are looked up by trigram and match anywhere in a word, shorter ones match the
+# start of a word. Only the entries of the rarest trigram or prefix of the query are checked against the whole query.
+class SearchIndex:
+    EMPTY = array("I")
+
+    def __init__(self, chunk_size=200):
+        self.texts = []  # Normalized text of each entry (a song id), starting with a space
+        self.trigrams = {}  # trigram -> array("I") of the entries with a word containing it
+        self.prefixes = {}  # first one or two letters of a word -> array("I") of entries
+        self.generation = 0  # Bumped by clear(), additions meant for the previous playlist are dropped
+        self.chunk_size = chunk_size  # Entries added per lock hold, so a keystroke never waits long
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def normalize(text):
+        # Lowercase words without punctuation, each preceded by a space.
+        return "".join(" " + word for word in re.findall(r"[^\W_]+", text.casefold()))
+
+
+    @staticmethod
+    def keys(text):
+        # Trigrams and short prefixes of the words of a normalized text.
+        words = text.split()
+        trigrams = {word[i:i + 3] for word in words for i in range(len(word) - 2)}
+        return trigrams, {word[:1] for word in words} | {word[:2] for word in words}
+
+
+    def clear(self):
+        with self.lock:
+            self.texts = []
+            self.trigrams = {}
+            self.prefixes = {}
+            self.generation += 1
+
+
+    def add(self, generation, entries):
+        # Adds (entry, text) pairs, text added to an entry that already has some is appended. Called on worker threads.
+        prepared = []
+        for entry, text in entries:
+            text = self.normalize(text)
+            if text:
+                prepared.append((entry, text, self.keys(text)))
+
+        for start in range(0, len(prepared), self.chunk_size):
+            with self.lock:
+                if generation != self.generation:
+                    return  # The playlist was cleared meanwhile
+                for entry, text, (trigrams, prefixes) in prepared[start:start + self.chunk_size]:
+                    if entry >= len(self.texts):
+                        self.texts.extend([""] * (entry + 1 - len(self.texts)))
+                    old = self.texts[entry]
+                    if old:
+                        old_trigrams, old_prefixes = self.keys(old)
+                        trigrams, prefixes = trigrams - old_trigrams, prefixes - old_prefixes
+                    self.texts[entry] = old + text
+                    for key in trigrams:
+                        self.trigrams.setdefault(key, array("I")).append(entry)
+                    for key in prefixes:
+                        self.prefixes.setdefault(key, array("I")).append(entry)
+
+
+    def forget(self, generation, entries):
+        # Removes the text of the given entries (renamed songs), their new text is added afterwards.
+        with self.lock:
+            if generation != self.generation:
+                return
+            entries = {entry for entry in entries if entry < len(self.texts) and self.texts[entry]}
+            trigrams, prefixes = set(), set()
+            for entry in entries:
+                entry_trigrams, entry_prefixes = self.keys(self.texts[entry])
+                trigrams |= entry_trigrams
+                prefixes |= entry_prefixes
+                self.texts[entry] = ""
+            for postings, keys in ((self.trigrams, trigrams), (self.prefixes, prefixes)):
+                for key in keys:
+                    postings[key] = array("I", [entry for entry in postings[key] if entry not in entries])
+
+
+    def search(self, query):
+        # Returns the sorted entries matching every term of the query, or None for an empty query.
+        terms = self.normalize(query).split()
+        if not terms:
+            return None
+        long_terms = [term for term in terms if len(term) >= 3]
+        short_terms = [" " + term for term in terms if len(term) < 3]
+        with self.lock:
+            postings = [self.prefixes.get(term[1:], self.EMPTY) for term in short_terms]
+            postings.extend(self.trigrams.get(term[i:i + 3], self.EMPTY) for term in long_terms for i in range(len(term) - 2))
+            matches = min(postings, key=len)
+            texts = self.texts
+            for term in long_terms + short_terms:
+                matches = [entry for entry in matches if term in texts[entry]]  # One pass per term, each one shorter
+        matches.sort()  # Tags are added after the names, so the candidates aren't always in order
+        return matches
+
+
+# CredentialStore: SQLite store of the user accounts, shared by the login, sign up and reset password screens.
+# Lookups and updates touch a single record, and WAL mode lets several instances write without losing updates.
+class CredentialStore:
+    def __init__(self, db_path, legacy_path=None):
+        self.db_path = db_path
+        self.legacy_path = legacy_path  # Pickled dict of older versions, imported once
+        self.connection = None  # Opened on first use
+        self.lock = threading.RLock()
+
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)  # Waits for other writers
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            imported = False
+            with self.connection:
+                self.connection.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT NOT NULL)")
+                if self.connection.execute("PRAGMA user_version").fetchone()[0] == 0:
+                    imported = self.import_legacy_users()
+                    self.connection.execute("PRAGMA user_version = 1")
+            if imported:
+                self.remove_legacy_file()  # Only once the accounts are committed
+        return self.connection
+
+
+    def import_legacy_users(self):
+        # Copies the accounts of user_data.pkl into the database, returns True if they were imported.
+        if not self.legacy_path or not os.path.exists(self.legacy_path):
+            return False
+        try:
+            with open(self.legacy_path, "rb") as file:
+                users = pickle.load(file)
+        except (pickle.UnpicklingError, EOFError, Exception) as e:
+            print(f"Error loading user data: {e}")
+            return False
+        if not isinstance(users, dict):
+            return False
+        self.connection.executemany("INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)", users.items())
+        print(f"Imported {len(users)} users from {self.legacy_path}")
+        return True
+
+
+    def remove_legacy_file(self):
+        # user_data.pkl holds plaintext passwords, it is overwritten with zeros before it's removed.
+        try:
+            with open(self.legacy_path, "r+b") as file:
+                file.write(bytes(os.fstat(file.fileno()).st_size))
+                file.flush()
+                os.fsync(file.fileno())
+            os.remove(self.legacy_path)
+        except OSError as e:
+            print(f"Error removing {self.legacy_path}: {e}")
+
+
+    def get_password(self, username):
+        # Returns the saved password of a user, or None if the username doesn't exist.
+        with self.lock:
+            row = self.connect().execute("SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+
+    def add_user(self, username, password):
+        # Adds a new user, returns False if the username already exists.
+        with self.lock:
+            try:
+                with self.connect():
+                    self.connection.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
+            except sqlite3.IntegrityError:
+                return False
+        return True
+
+
+    def set_password(self, username, password):
+        # Changes the password of an existing user, returns False if the username doesn't exist.
+        with self.lock:
+            with self.connect():
+                cursor = self.connection.execute("UPDATE users SET password = ? WHERE username = ?", (password, username))
+        return cursor.rowcount == 1
+
+
+# AssetCache: Images and fonts shared by all screens, each file is read from disk once.
+# CTkImages are kept per size, fonts per size and weight, so showing a screen again reuses them.
+class AssetCache:
+    def __init__(self, directory, family="Times New Roman"):
+        self.directory = directory  # imgs folder next to this file
+        self.family = family  # Font family used by every screen
+        self.decoded = {}  # File name -> decoded PIL image
+        self.images = {}  # (file name, size) -> CTkImage
+        self.fonts = {}  # (size, bold) -> CTkFont
+
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+    def image(self, name, size):
+        key = (name, size)
+        if key not in self.images:
+            if name not in self.decoded:
+                with Image.open(self.path(name)) as image:
+                    image.load()  # Decode now, the file is closed afterwards
+                    self.decoded[name] = image.copy()
+            self.images[key] = CTkImage(light_image=self.decoded[name], size=size)
+        return self.images[key]
+
+
+    def font(self, size, bold=False):
+        # Fonts need the Tk root, so they are created on first use.
+        key = (size, bold)
+        if key not in self.fonts:
+            if bold:
+                self.fonts[key] = CTkFont(family=self.family, size=size, weight="bold")
+            else:
+                self.fonts[key] = CTkFont(family=self.family, size=size)
+        return self.fonts[key]
+
+
+# SessionStore: The session state (stay logged in, username, remembered login) kept in one pickled dict.
+# Changes are held in memory and written a moment later, several changes in a row become one write.
+# Writes go to a temporary file that replaces session.pkl, so a crash never leaves a half-written file.
+class SessionStore:
+    VERSION = 1  # Schema version of session.pkl
+    DEFAULTS = {"version": VERSION,
+                "stay_logged_in": False,  # Open the music player directly at startup
+                "username": "User",  # User of the last session
+                "remember_me": False,  # State of the "Stay logged in" checkbox
+                "remembered_user": None,  # Username filled in on the login screen
+                "login_time": None}  # When remembered_user logged in, the entry expires after 15 days
+
+    def __init__(self, path, legacy_state_path=None, legacy_info_path=None, delay=0.5):
+        self.path = path
+        self.legacy_state_path = legacy_state_path  # login_state.pkl of older versions
+        self.legacy_info_path = legacy_info_path  # login_info.pkl of older versions
+        self.delay = delay  # Seconds to wait for more changes before writing
+        self.state = None  # Loaded on first use
+        self.timer = None  # Pending write
+        self.lock = threading.RLock()
+
+
+    def load(self):
+        # Reads session.pkl, or the older login files if it doesn't exist yet.
+        if self.state is not None:
+            return self.state
+        state = None
+        try:
+            with open(self.path, "rb") as file:
+                state = pickle.load(file)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error loading session: {e}")
+        if isinstance(state, dict):
+            self.state = self.migrate(state)
+        else:
+            self.state = self.import_legacy_files()
+            if self.state is None:
+                self.state = dict(self.DEFAULTS)
+            elif self.write():  # The old files are removed once the imported state is saved, else they're imported again next time
+                for legacy_path in (self.legacy_state_path, self.legacy_info_path):
+                    if legacy_path and os.path.exists(legacy_path):
+                        os.remove(legacy_path)
+        return self.state
+
+
+    def migrate(self, state):
+        # Brings a session saved by an older version up to the current schema.
+        migrated = dict(self.DEFAULTS)
+        migrated.update((key, value) for key, value in state.items() if key in self.DEFAULTS)
+        migrated["version"] = self.VERSION
+        return migrated
+
+
+    def import_legacy_files(self):
+        # Builds the session from login_state.pkl (a dict, or a bare bool) and login_info.pkl (username, time).
+        state = dict(self.DEFAULTS)
+        found = False
+        for legacy_path in (self.legacy_state_path, self.legacy_info_path):
+            if not legacy_path or not os.path.exists(legacy_path):
+                continue
+            try:
+                with open(legacy_path, "rb") as file:
+                    data = pickle.load(file)
+            except Exception as e:
+                print(f"Error loading {legacy_path}: {e}")
+                continue
+            found = True
+            if isinstance(data, dict):
+                state["stay_logged_in"] = bool(data.get("stay_logged_in", False))
+                state["remember_me"] = state["stay_logged_in"]
+                state["username"] = data.get("username", "User")
+            elif isinstance(data, bool):
+                state["remember_me"] = data  # Written when the login screen was closed
+            elif isinstance(data, tuple) and len(data) == 2:
+                state["remembered_user"], state["login_time"] = data
+        return state if found else None
+
+
+    def get(self, key):
+        with self.lock:
+            return self.load()[key]
+
+
+    def update(self, **changes):
+        # Changes the session in memory and schedules a write.
+        with self.lock:
+            self.load().update(changes)
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+
+    def flush(self):
+        # Writes pending changes now.
+        with self.lock:
+            if self.timer is None:
+                return
+            self.timer.cancel()
+            self.timer = None
+            self.write()
+
+
+    def write(self):
+        temporary_path = self.path + ".tmp"
+        try:
+            with open(temporary_path, "wb") as file:
+                pickle.dump(self.state, file)
+                file.flush()
+                os.fsync(file.fileno())  # On disk before it replaces the old file
+            os.replace(temporary_path, self.path)
+            return True
+        except Exception as e:
+            print(f"Error saving session: {e}")
+            return False
+
+
+# WaveformService: Waveform overviews of played songs, computed in a worker process and cached as one file per song.
+class WaveformService:
+    def __init__(self, directory, buckets=1000):
+        self.directory = directory  # Created when the first overview is saved
+        self.buckets = buckets  # Resolution of an overview
+        self.enabled = importlib.util.find_spec("numpy") is not None
+        self.pool = None  # Worker process, started by the first song without an overview
+        self.pending = {}  # path -> future of overviews being computed
+
+
+    def file_for(self, path):
+        return os.path.join(self.directory, hashlib.sha1(path.encode("utf-8", "surrogateescape")).hexdigest() + ".wf")
+
+
+    def load(self, path):
+        # Returns the cached overview of an unchanged file, or None. Reads a few kilobytes.
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+            with open(self.file_for(path), "rb") as file:
+                overview = WaveformOverview.from_blob(file.read())
+        except OSError:
+            return None
+        if overview is None or overview.key != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return overview
+
+
+    def fetch(self, path):
+        # Returns a future with the blob of the song's overview (or None if it can't be decoded), computed in the worker.
+        path = os.path.abspath(path)
+        future = self.pending.get(path)
+        if future is None:
+            if self.pool is None:
+                self.pool = start_pool(1)
+            future = self.pool.submit(compute_waveform, path, self.buckets)
+            self.pending[path] = future
+            future.add_done_callback(lambda future: self.store(path, future))
+        return future
+
+
+    def store(self, path, future):
+        # Called when the worker has finished an overview, saves it next to the others.
+        self.pending.pop(path, None)
+        try:
+            blob = future.result()
+        except Exception:
+            return  # Reported by the screen that asked for it
+        if blob is None:
+            return
+        overview_path = self.file_for(path)
+        temporary_path = overview_path + ".tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temporary_path, "wb") as file:
+                file.write(blob)
+            os.replace(temporary_path, overview_path)
+        except OSError as e:
+            print(f"Error saving waveform: {e}")
+
+
+    def close(self):
+        # Stops the worker process once its current song is done.
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+
+# LibraryIndex: Persistent SQLite index of the music library, keyed by file path.
+# Stores size/mtime and the extracted metadata so a reload only re-reads new or modified files.
+class LibraryIndex:
+    # Statements that upgrade an older library.db, applied in order of its user_version
+    MIGRATIONS = [
+        ["CREATE TABLE IF NOT EXISTS tracks ("
+         "path TEXT PRIMARY KEY, directory TEXT NOT NULL, name TEXT NOT NULL, "
+         "size INTEGER, mtime_ns INTEGER, duration REAL, "
+         "title TEXT, artist TEXT, album TEXT, bitrate INTEGER)",
+         "CREATE INDEX IF NOT EXISTS tracks_directory ON tracks (directory)",
+         "CREATE TABLE IF NOT EXISTS folders (directory TEXT PRIMARY KEY, mtime_ns INTEGER)"],
+        ["ALTER TABLE folders ADD COLUMN extensions TEXT",
+         "ALTER TABLE folders ADD COLUMN subdirs TEXT"],
+        ["ALTER TABLE tracks ADD COLUMN tagged INTEGER NOT NULL DEFAULT 0",
+         "UPDATE tracks SET tagged = 1 WHERE duration IS NOT NULL"],
+        ["ALTER TABLE tracks ADD COLUMN frame_index BLOB"],
+        ["ALTER TABLE tracks ADD COLUMN loudness REAL",
+         "ALTER TABLE tracks ADD COLUMN peak REAL"],
+        ["ALTER TABLE tracks ADD COLUMN format TEXT",
+         "UPDATE tracks SET tagged = 0"],  # Probed again for their format
+    ]
+
+    def __init__(self, db_path):
+        self.db_path = db_path  # Stored next to users.db
+        self.connection = None  # Opened on first use
+        self.lock = threading.RLock()  # Serializes access from the scanner thread and the UI
+
+
+    def connect(self):
+        # Opens the database and brings its schema up to date.
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+            for statements in self.MIGRATIONS[version:]:
+                for statement in statements:
+                    self.connection.execute(statement)
+            self.connection.execute(f"PRAGMA user_version = {len(self.MIGRATIONS)}")
+            self.connection.commit()
+        return self.connection
+
+
+    def scan(self, directory, extensions=SONG_EXTENSIONS, max_depth=None, cancel_event=None):
+        # Returns every song under the directory as a (path relative to it, size, mtime_ns) tuple.
+        names = []
+        for batch in self.scan_batches(directory, extensions, max_depth, cancel_event):
+            names.extend(batch)
+        return names
+
+
+    def scan_batches(self, directory, extensions=SONG_EXTENSIONS, max_depth=None, cancel_event=None):
+        # Walks the directory tree and yields the songs of each folder as (path relative to the directory, size, mtime_ns) tuples.
+        root_directory = os.path.abspath(directory)
+        pending = [(root_directory, 0)]
+        while pending:
+            if cancel_event is not None and cancel_event.is_set():
+                return  # The scan was cancelled
+            folder, depth = pending.pop()
+
+            try:
+                names, subdirs = self.scan_folder(folder, extensions, cancel_event)
+            except OSError as e:
+                print(f"Error scanning {folder}: {e}")  # Skip folders that can't be read
+                continue
+
+            if max_depth is None or depth < max_depth:
+                pending.extend((os.path.join(folder, subdir), depth + 1) for subdir in reversed(subdirs))
+
+            prefix = os.path.relpath(folder, root_directory)
+            if names:
+                yield names if prefix == os.curdir else [(os.path.join(prefix, name), size, mtime_ns) for name, size, mtime_ns in names]
+
+
+    def scan_folder(self, folder, extensions=SONG_EXTENSIONS, cancel_event=None):
+        # Returns the songs (name, size, mtime_ns) and subfolders of one folder, refreshing only the entries that changed.
+        # The size and mtime of a file rewritten in place are refreshed when the metadata service finds it changed.
+        extensions = tuple(extensions)
+        with self.lock:
+            db = self.connect()
+            folder_mtime = os.stat(folder).st_mtime_ns
+            row = db.execute("SELECT mtime_ns, extensions, subdirs FROM folders WHERE directory = ?",
+                             (folder,)).fetchone()
+            known = {name: (size, mtime_ns) for name, size, mtime_ns in db.execute(
+                "SELECT name, size, mtime_ns FROM tracks WHERE directory = ? ORDER BY name", (folder,))}
+
+
+            # Nothing was added, removed or renamed since the last scan, the folder isn't listed again
+            unchanged = row is not None and row[0] == folder_mtime and row[1] == "\n".join(extensions)
+        if unchanged:
+            # Nothing to read, the files come from the index
+            return [(name, size, mtime_ns) for name, (size, mtime_ns) in known.items()], (row[2].split("\n") if row[2] else [])
+
+
+        names = []
+        subdirs = []
+        changed = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if cancel_event is not None and cancel_event.is_set():
+                    return names, []  # Leave the folder marked as unscanned
+                try:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                        continue
+                    if not entry.name.lower().endswith(extensions) or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError as e:
+                    if entry.name in known:  # Listed but not readable right now, its stored metadata is kept
+                        print(f"Error reading {entry.path}: {e}")
+                        names.append((entry.name,) + known[entry.name])
+                    continue
+                names.append((entry.name, stat.st_size, stat.st_mtime_ns))
+                if known.get(entry.name) != (stat.st_size, stat.st_mtime_ns):
+                    changed.append((entry.name, entry.path, stat))
+
+
+        # New or modified files are stored without tags, the metadata service parses them later
+        names.sort()
+        subdirs.sort()
+        removed = set(known).difference(name for name, _, _ in names)
+        with self.lock:
+            db = self.connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO tracks (path, directory, name, size, mtime_ns, tagged) VALUES (?, ?, ?, ?, ?, 0)",
+                [(path, folder, name, stat.st_size, stat.st_mtime_ns) for name, path, stat in changed])
+
+
+            # Forget files that were deleted from the folder
+            db.executemany("DELETE FROM tracks WHERE path = ?",
+                           [(os.path.join(folder, name),) for name in removed])
+            db.execute("INSERT OR REPLACE INTO folders (directory, mtime_ns, extensions, subdirs) VALUES (?, ?, ?, ?)",
+                       (folder, folder_mtime, "\n".join(extensions), "\n".join(subdirs)))
+            db.commit()
+
+        if changed or removed:
+            print(f"Indexed {folder}: {len(changed)} updated, {len(removed)} removed")
+        return names, subdirs
+
+
+    def get(self, path):
+        # Returns the stored size, mtime and metadata of a file, or None if it isn't indexed.
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT size, mtime_ns, tagged, duration, title, artist, album, bitrate, format FROM tracks WHERE path = ?",
+                (os.path.abspath(path),)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("size", "mtime_ns", "tagged") + METADATA_KEYS, row))
+
+
+    def store_metadata(self, rows):
+        # Saves parsed metadata, rows are (path, size, mtime_ns, metadata) tuples.
+        with self.lock:
+            db = self.connect()
+            db.executemany(
+                "INSERT INTO tracks (path, directory, name, size, mtime_ns, tagged, "
+                "duration, title, artist, album, bitrate, format) VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, tagged = 1, "
+                "duration = excluded.duration, title = excluded.title, artist = excluded.artist, "
+                "album = excluded.album, bitrate = excluded.bitrate, format = excluded.format, "
+                "frame_index = CASE WHEN tracks.size = excluded.size AND tracks.mtime_ns = excluded.mtime_ns "
+                "THEN tracks.frame_index END, "  # A frame index and loudness are only kept while the file is unchanged
+                "loudness = CASE WHEN tracks.size = excluded.size AND tracks.mtime_ns = excluded.mtime_ns "
+                "THEN tracks.loudness END, "
+                "peak = CASE WHEN tracks.size = excluded.size AND tracks.mtime_ns = excluded.mtime_ns "
+                "THEN tracks.peak END",
+                [(path, os.path.dirname(path), os.path.basename(path), size, mtime_ns,
+                  *(metadata[key] for key in METADATA_KEYS)) for path, size, mtime_ns, metadata in rows])
+            db.commit()
+
+
+    def get_frame_index(self, path, size, mtime_ns):
+        # Returns the stored frame index blob of an unchanged file, or None.
+        with self.lock:
+            row = self.connect().execute(
+                "SELECT frame_index FROM tracks WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, size, mtime_ns)).fetchone()
+        return row[0] if row else None
+
+
+    def store_frame_index(self, path, size, mtime_ns, blob):
+        # Saves the frame index blob of a file, unless the file changed in the meantime.
+        with self.lock:
+            db = self.connect()
+            db.execute(
+                "INSERT INTO tracks (path, directory, name, size, mtime_ns, frame_index) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET frame_index = excluded.frame_index "
+                "WHERE tracks.size = excluded.size AND tracks.mtime_ns = excluded.mtime_ns",
+                (path, os.path.dirname(path), os.path.basename(path), size, mtime_ns, blob))
+            db.commit()
+
+
+    def get_loudness(self, paths, chunk_size=500):
+        # Returns {path: (size, mtime_ns, loudness, peak)} of the given files that were analyzed, one query per chunk of paths.
+        found = {}
+        with self.lock:
+            db = self.connect()
+            for start in range(0, len(paths), chunk_size):
+                chunk = paths[start:start + chunk_size]
+                found.update((row[0], row[1:]) for row in db.execute(
+                    "SELECT path, size, mtime_ns, loudness, peak FROM tracks "
+                    f"WHERE loudness IS NOT NULL AND path IN ({', '.join('?' * len(chunk))})", chunk))
+        return found
+
+
+    def store_loudness(self, rows):
+        # Saves analysis results, rows are (path, size, mtime_ns, loudness, peak) tuples. Files that changed meanwhile are skipped.
+        with self.lock:
+            db = self.connect()
+            db.executemany(
+                "INSERT INTO tracks (path, directory, name, size, mtime_ns, loudness, peak) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (path) DO UPDATE SET loudness = excluded.loudness, peak = excluded.peak "
+                "WHERE tracks.size = excluded.size AND tracks.mtime_ns = excluded.mtime_ns",
+                [(path, os.path.dirname(path), os.path.basename(path), size, mtime_ns, loudness, peak)
+                 for path, size, mtime_ns, loudness, peak in rows])
+            db.commit()
+
+
+# MetadataService: Cached access to song durations and tags.
+# Recently used entries live in an in-memory LRU on top of the library index, both keyed by (path, size, mtime),
+# and the songs of a loaded folder are parsed ahead of time on a thread pool.
+class MetadataService:
+    def __init__(self, index, capacity=4096, workers=4, chunk_size=200):
+        self.index = index  # On-disk cache
+        self.capacity = capacity  # Maximum entries kept in memory
+        self.chunk_size = chunk_size  # Songs parsed per prefetch task
+        self.cache = OrderedDict()  # path -> (size, mtime_ns, metadata), least recently used first
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="metadata")  # Bulk prefetching
+        self.urgent = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metadata-urgent")  # Songs about to play
+        self.indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="frame-index")  # MP3 frame indexes
+        self.generation = 0  # Bumped when a new folder is loaded, so stale prefetches stop early
+
+
+    def remember(self, path, size, mtime_ns, metadata):
+        # Adds an entry to the in-memory LRU, evicting the least recently used ones.
+        with self.lock:
+            self.cache[path] = (size, mtime_ns, metadata)
+            self.cache.move_to_end(path)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+
+    def lookup(self, path, stat):
+        # Returns the cached metadata of an unchanged file without parsing it, or None.
+        key = (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            entry = self.cache.get(path)
+            if entry is not None and entry[:2] == key:
+                self.cache.move_to_end(path)
+                return entry[2]
+
+        stored = self.index.get(path)
+        if stored is not None and stored["tagged"] and (stored["size"], stored["mtime_ns"]) == key:
+            metadata = {key: stored[key] for key in METADATA_KEYS}
+            self.remember(path, stat.st_size, stat.st_mtime_ns, metadata)
+            return metadata
+        return None
+
+
+    def peek(self, path):
+        # Returns the cached metadata of a file, or None if it hasn't been parsed yet. Never parses.
+        try:
+            return self.lookup(os.path.abspath(path), os.stat(path))
+        except OSError:
+            return None
+
+
+    def get(self, path):
+        # Returns the metadata of a file, parsing it only if it isn't cached yet.
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        metadata = self.lookup(path, stat)
+        if metadata is None:
+            metadata = read_song_tags(path)
+            self.index.store_metadata([(path, stat.st_size, stat.st_mtime_ns, metadata)])
+            self.remember(path, stat.st_size, stat.st_mtime_ns, metadata)
+        return metadata
+
+
+    def fetch(self, path):
+        # Returns a future with the metadata of a file, ahead of any queued prefetching.
+        return self.urgent.submit(self.get, path)
+
+
+    def frame_index(self, path):
+        # Returns the Mp3FrameIndex of a file (or None if it isn't a valid MP3), built once and cached in the library index.
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        blob = self.index.get_frame_index(path, stat.st_size, stat.st_mtime_ns)
+        if blob is not None:
+            return Mp3FrameIndex.from_blob(blob)
+
+        index = build_mp3_frame_index(path)
+        if index is not None:
+            self.index.store_frame_index(path, stat.st_size, stat.st_mtime_ns, index.to_blob())
+        return index
+
+
+    def fetch_frame_index(self, path):
+        # Returns a future with the frame index of a file, built in the background.
+        return self.indexer.submit(self.frame_index, path)
+
+
+    def cancel_prefetch(self):
+        # Drops the prefetching of the previously loaded folder.
+        self.generation += 1
+
+
+    def close(self):
+        # Drops the queued parsing without waiting, so the program doesn't wait for it at exit.
+        # The chunks already running stop at their next song.
+        self.cancel_prefetch()
+        for executor in (self.executor, self.urgent, self.indexer):
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+    def prefetch(self, paths):
+        # Parses the given files on the thread pool, in chunks written to the index in one transaction.
+        # Returns the futures of the chunks, each with the (path, metadata) pairs of its files.
+        paths = [os.path.abspath(path) for path in paths]
+        return [self.executor.submit(self.prefetch_chunk, paths[start:start + self.chunk_size], self.generation)
+                for start in range(0, len(paths), self.chunk_size)]
+
+
+    def prefetch_chunk(self, paths, generation):
+        # Worker thread: parses the files of one chunk that aren't cached yet.
+        rows = []
+        found = []
+        for path in paths:
+            if generation != self.generation:
+                break  # Another folder was loaded in the meantime
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            metadata = self.lookup(path, stat)
+            if metadata is None:
+                try:
+                    metadata = read_song_tags(path)
+                except OSError as e:
+                    print(f"Error reading tags from {path}: {e}")  # Not stored, it's read again next time
+                    continue
+                rows.append((path, stat.st_size, stat.st_mtime_ns, metadata))
+                self.remember(path, stat.st_size, stat.st_mtime_ns, metadata)
+            found.append((path, metadata))
+        if rows:
+            self.index.store_metadata(rows)
+        return found
+
+
+# LoudnessAnalyzer: Measures the loudness and peak of songs in worker processes, so every song plays at the same level.
+# Each song is decoded once, the results are stored in the library index with the file's size and mtime.
+class LoudnessAnalyzer:
+    def __init__(self, index, target, workers=None, chunk_size=4):
+        self.index = index  # On-disk cache of the results
+        self.target = target  # Loudness in dBFS that songs are brought to, None turns normalization off
+        self.workers = workers or min(os.cpu_count() or 1, 2)  # Two at most, the songs are analyzed while others play
+        self.chunk_size = chunk_size  # Songs per task sent to a worker process
+        self.enabled = target is not None and importlib.util.find_spec("numpy") is not None
+        self.gains = {}  # path -> gain of analyzed songs, filled by the feeder thread and the analysis callbacks
+        self.pending = set()  # Paths queued or being analyzed
+        self.lock = threading.Lock()
+        self.pool = None  # Worker processes, started by the first analysis
+        self.feeder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="loudness")  # Filters out analyzed songs
+
+
+    def gain(self, path):
+        # Returns the volume factor that brings the song to the target loudness, 1.0 until it's analyzed.
+        # Called on the Tk thread, so only the gains in memory are looked at, a song that isn't there is analyzed.
+        if not self.enabled:
+            return 1.0
+        path = os.path.abspath(path)
+        with self.lock:
+            gain = self.gains.get(path)
+        if gain is None:
+            self.analyze([path])
+            return 1.0
+        return gain
+
+
+    def gain_from(self, loudness, peak, max_boost=12.0):
+        # Volume factor for a measured song, lowered where the peak would otherwise clip.
+        gain_db = min(self.target - loudness, max_boost)  # Near-silent songs aren't blown up
+        if peak > 0:
+            gain_db = min(gain_db, -20 * math.log10(peak))
+        return 10 ** (gain_db / 20)
+
+
+    def analyze(self, paths):
+        # Analyzes the songs that aren't in the index yet, without blocking the caller.
+        if not self.enabled:
+            return
+        paths = [os.path.abspath(path) for path in paths]
+        with self.lock:
+            paths = [path for path in paths if path not in self.pending]
+            self.pending.update(paths)
+        if paths:
+            self.feeder.submit(self.submit, paths)
+
+
+    def submit(self, paths):
+        # Feeder thread: takes the stored results of unchanged songs, and sends the other songs to the worker processes.
+        stored = self.index.get_loudness(paths)
+        missing = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            entry = stored.get(path)
+            with self.lock:
+                if stat is not None and entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                    self.gains[path] = self.gain_from(*entry[2:])
+                else:
+                    self.gains.pop(path, None)  # Changed since it was analyzed
+                if stat is None or path in self.gains:
+                    self.pending.discard(path)
+                else:
+                    missing.append(path)
+
+        if missing and self.pool is None:
+            self.pool = start_pool(self.workers)
+        for start in range(0, len(missing), self.chunk_size):
+            chunk = missing[start:start + self.chunk_size]
+            try:
+                future = self.pool.submit(analyze_loudness, chunk)
+            except RuntimeError:
+                return  # The pool was shut down
+            future.add_done_callback(lambda future, chunk=chunk: self.store(future, chunk))
+
+
+    def store(self, future, chunk):
+        # Called when a worker has finished a chunk, saves its results.
+        rows = []
+        try:
+            rows = future.result()
+        except Exception as e:  # A worker died or the pool was shut down
+            print(f"Loudness analysis failed: {e}")
+        if rows:
+            self.index.store_loudness(rows)
+        with self.lock:
+            for path, size, mtime_ns, loudness, peak in rows:
+                self.gains[path] = self.gain_from(loudness, peak)
+            self.pending.difference_update(chunk)
+
+
+    def close(self):
+        # Stops the worker processes once their current songs are done, the others are analyzed next time.
+        self.feeder.shutdown(cancel_futures=True)
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+
+# Mp3Slice: Read-only file object that exposes an MP3 file from a frame offset onwards.
+# The mixer decodes it as a complete stream starting at that frame.
+class Mp3Slice(io.RawIOBase):
+    def __init__(self, path, offset):
+        self.file = open(path, "rb")
+        self.offset = offset
+        self.file.seek(offset)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.file.readinto(buffer)
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position += self.offset
+        return self.file.seek(position, whence) - self.offset
+
+    def tell(self):
+        return self.file.tell() - self.offset
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+# DirectoryScanner: Scans a directory on a worker thread and streams the songs back to the Tk loop.
+# The worker puts batches on a queue, and root.after drains it a bounded number of rows at a time.
+class DirectoryScanner:
+    def __init__(self, root, directory, on_batch, on_progress=None, on_done=None,
+                 extensions=SONG_EXTENSIONS, max_depth=None, batch_size=500, poll_interval=30):
+        self.root = root  # Tk root used to schedule the draining
+        self.directory = directory
+        self.on_batch = on_batch  # Called on the Tk thread with a list of (relative song path, size, mtime_ns) tuples
+        self.on_progress = on_progress  # Called on the Tk thread with the number of songs found so far
+        self.on_done = on_done  # Called on the Tk thread with (songs found, error or None)
+        self.extensions = extensions
+        self.max_depth = max_depth  # None scans every subfolder, 0 only the directory itself
+        self.batch_size = batch_size  # Maximum rows handed to the UI per tick
+        self.poll_interval = poll_interval  # Milliseconds between two drains
+
+        self.queue = queue.Queue()
+        self.pending = deque()  # Songs received from the worker, waiting for the UI
+        self.cancel_event = threading.Event()
+        self.finished = False
+        self.error = None
+        self.found = 0
+        self.after_id = None
+
+
+    def start(self):
+        # Starts the worker thread and the draining loop.
+        threading.Thread(target=self.run, daemon=True).start()
+        self.after_id = self.root.after(self.poll_interval, self.drain)
+
+
+    def cancel(self):
+        # Stops the worker and the draining loop, songs not inserted yet are dropped.
+        self.cancel_event.set()
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
+
+
+    def run(self):
+        # Worker thread: walks the directory through the library index.
+        try:
+            for names in library_index.scan_batches(self.directory, self.extensions, self.max_depth, self.cancel_event):
+                self.queue.put(names)
+        except Exception as e:
+            self.queue.put(e)
+        finally:
+            self.queue.put(None)  # Marks the end of the scan
+
+
+    def drain(self):
+        # Tk thread: hands at most batch_size songs to the UI, then reschedules itself.
+        self.after_id = None
+        while not self.finished and len(self.pending) < self.batch_size:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.finished = True
+            elif isinstance(item, Exception):
+                self.error = item
+            else:
+                self.pending.extend(item)
+
+        batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+        if batch:
+            self.found += len(batch)
+            self.on_batch(batch)
+            if self.on_progress:
+                self.on_progress(self.found)
+
+        if self.cancel_event.is_set():
+            return
+        if self.finished and not self.pending:
+            if self.on_done:
+                self.on_done(self.found, self.error)
+            return
+        self.after_id = self.root.after(self.poll_interval, self.drain)
+
+
+# FolderWatcher: Follows the changes in a loaded folder and hands them to the Tk thread in debounced batches.
+# Uses inotify on Linux, elsewhere (or when inotify fails) it compares the folder listings every few seconds.
+# Changes are reported relative to the previous batch: songs added, songs removed and songs renamed (old -> new path).
+class FolderWatcher:
+    # inotify event flags, see inotify(7)
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, length of the name that follows
+
+    def __init__(self, root, directory, known, on_changes, extensions=SONG_EXTENSIONS, debounce=500, max_delay=5000, poll_interval=2000):
+        self.root = root  # Tk root used to schedule the draining
+        self.directory = os.path.abspath(directory)
+        self.known = set(known)  # Songs on disk as paths relative to the directory, as far as the watcher knows
+        self.on_changes = on_changes  # Called on the Tk thread with (added list, removed set, renamed dict)
+        self.extensions = tuple(extensions)
+        self.debounce = debounce  # Milliseconds without changes before a batch is handed over
+        self.max_delay = max_delay  # Milliseconds after which a batch is handed over even if changes keep coming
+        self.poll_interval = poll_interval  # Milliseconds between two listings when polling
+        self.backend = None  # "inotify" or "polling"
+
+        self.lock = threading.Lock()  # Guards the batch, shared by the watcher thread and the Tk thread
+        self.added = {}  # Songs added since the last batch (a dict keeps their order)
+        self.removed = set()  # Songs of the last batch that are gone
+        self.renamed = {}  # Songs of the last batch -> their current path
+        self.origins = {}  # Current path -> path in the last batch, for songs renamed again
+        self.first_change = None  # time.monotonic() of the first and the last change of the batch
+        self.last_change = None
+        self.stop_event = threading.Event()
+        self.after_id = None
+
+        self.fd = None  # inotify instance
+        self.watches = {}  # inotify watch descriptor -> folder relative to the directory
+        self.moves = {}  # inotify cookie -> (path, is a folder) of a move whose destination hasn't been seen
+        self.folders = {}  # Polling: folder -> (mtime_ns, {song: inode}, subfolders) of the last listing
+        self.unsettled = {}  # Polling: new song -> (size, mtime_ns), reported once it stops changing
+        self.inodes = {}  # Polling: song -> inode in the last listing
+
+
+    def start(self):
+        # Starts the watcher thread and the draining loop. The folder is listed and watched on the thread,
+        # a large library on a network drive takes a while.
+        threading.Thread(target=self.run, name="folder-watcher", daemon=True).start()
+        self.after_id = self.root.after(self.debounce, self.drain)
+
+
+    def stop(self):
+        # Stops the draining loop, the watcher thread ends within half a second.
+        self.stop_event.set()
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
+
+
+    def is_song(self, path):
+        return path.lower().endswith(self.extensions)
+
+
+    # Batch bookkeeping, called with the lock held
+
+    def changed(self):
+        self.last_change = time.monotonic()
+        if self.first_change is None:
+            self.first_change = self.last_change
+
+
+    def record_add(self, path):
+        if path in self.known:
+            return  # Rewritten in place
+        self.known.add(path)
+        if path in self.removed:
+            self.removed.discard(path)  # Replaced by a new file, it stays in the playlist
+        else:
+            self.added[path] = None
+        self.changed()
+
+
+    def record_remove(self, path):
+        if path not in self.known:
+            return
+        self.known.discard(path)
+        if path in self.added:
+            del self.added[path]
         else:
-            print("login_state.pkl not found, returning defaults.")  # If file not found, return default values
-           
-            stay_logged_in = False  # Default to not staying logged in
-            username = "User"  # Default username
-            save_login_state(stay_logged_in, username)  # Save the default login state
-            return stay_logged_in, username
-
-    except (FileNotFoundError, ValueError) as e:
-        print(f"Error loading login state: {e}")  # Print any errors that occur while loading the state
-        stay_logged_in = False  # Default to not staying logged in
-        username = "User"  # Default username
-        save_login_state(stay_logged_in, username)  # Save the default login state
-        return stay_logged_in, username
-
-
-# Function to save the login state to a file.
+            origin = self.origins.pop(path, path)
+            self.renamed.pop(origin, None)
+            self.removed.add(origin)
+        self.changed()
+
+
+    def record_rename(self, old, new):
+        if old not in self.known:
+            self.record_add(new)
+            return
+        self.record_remove(new)  # A song renamed over another one replaces it
+        self.known.discard(old)
+        self.known.add(new)
+        if old in self.added:
+            del self.added[old]
+            self.added[new] = None
+        else:
+            origin = self.origins.pop(old, old)
+            if origin == new:
+                self.renamed.pop(origin, None)  # Renamed back
+            else:
+                self.renamed[origin] = new
+                self.origins[new] = origin
+        self.changed()
+
+
+    def songs_under(self, folder):
+        prefix = folder + os.sep
+        return [path for path in self.known if path.startswith(prefix)]
+
+
+    # Tk thread
+
+    def drain(self):
+        # Hands over the batch once no change came in for the debounce time, then reschedules itself.
+        self.after_id = None
+        batch = None
+        with self.lock:
+            now = time.monotonic()
+            if self.first_change is not None and (now - self.last_change >= self.debounce / 1000
+                                                  or now - self.first_change >= self.max_delay / 1000):
+                self.expire_moves()
+                batch = (list(self.added), self.removed, self.renamed)
+                self.added, self.removed, self.renamed, self.origins = {}, set(), {}, {}
+                self.first_change = self.last_change = None
+        if batch is not None and any(batch):
+            self.on_changes(*batch)
+        if not self.stop_event.is_set():
+            self.after_id = self.root.after(self.debounce, self.drain)
+
+
+    # inotify
+
+    def open_inotify(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            songs = self.watch_tree("")
+        except OSError:
+            self.close_inotify()
+            raise
+        with self.lock:
+            self.reconcile(songs)  # Songs added or removed since the folder was loaded
+
+
+    def close_inotify(self):
+        if self.fd is not None:
+            os.close(self.fd)  # Also removes the watches
+            self.fd = None
+            self.watches = {}
+
+
+    def watch_tree(self, folder):
+        # Watches a folder and its subfolders, returns the songs in them.
+        songs = []
+        pending = [folder]
+        while pending:
+            folder = pending.pop()
+            path = os.path.join(self.directory, folder)
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, "Out of inotify watches (fs.inotify.max_user_watches)")
+                continue  # Removed meanwhile
+            self.watches[wd] = folder
+            try:
+                with os.scandir(path) as entries:  # Listed after the watch is added, so no song is missed
+                    for entry in entries:
+                        relative = os.path.join(folder, entry.name) if folder else entry.name
+                        if entry.is_dir():
+                            pending.append(relative)
+                        elif self.is_song(entry.name) and entry.is_file():
+                            songs.append(relative)
+            except OSError:
+                continue
+        return songs
+
+
+    def run(self):
+        # Watcher thread.
+        try:
+            self.open_inotify()
+            self.backend = "inotify"
+        except (OSError, AttributeError) as e:  # AttributeError: the C library has no inotify
+            print(f"Watching {self.directory} by polling, inotify is unavailable: {e}")
+            self.backend = "polling"
+        if self.backend == "inotify":
+            try:
+                self.read_events()
+            except OSError as e:
+                print(f"Watching {self.directory} by polling, inotify failed: {e}")
+                self.backend = "polling"
+            with self.lock:
+                self.close_inotify()
+        if self.backend == "polling":
+            self.poll()
+
+
+    def read_events(self):
+        while not self.stop_event.is_set():
+            ready, _, _ = select.select([self.fd], [], [], 0.5)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                continue
+            with self.lock:
+                self.handle_events(data)
+
+
+    def handle_events(self, data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + self.EVENT_HEADER.size:offset + self.EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += self.EVENT_HEADER.size + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                self.resync()  # Events were lost, compare with a listing instead
+                continue
+            folder = self.watches.get(wd)
+            if folder is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self.watches[wd]  # The folder was removed
+                continue
+            if mask & self.IN_DELETE_SELF:
+                if folder == "":
+                    for path in list(self.known):
+                        self.record_remove(path)  # The loaded folder itself was deleted
+                continue
+
+            path = os.path.join(folder, name) if folder else name
+            is_folder = bool(mask & self.IN_ISDIR)
+            if mask & self.IN_MOVED_FROM:
+                self.moves[cookie] = (path, is_folder)  # Paired with its IN_MOVED_TO, or a move out of the folder
+            elif mask & self.IN_MOVED_TO:
+                move = self.moves.pop(cookie, None)
+                if move is not None:
+                    self.moved(move[0], path, is_folder)
+                elif is_folder:
+                    self.add_folder(path)
+                elif self.is_song(name):
+                    self.record_add(path)
+            elif mask & self.IN_CREATE:
+                if is_folder:
+                    self.add_folder(path)  # New files are added when they're closed after writing
+            elif mask & self.IN_CLOSE_WRITE:
+                if self.is_song(name):
+                    self.record_add(path)
+            elif mask & self.IN_DELETE:
+                if is_folder:
+                    for song in self.songs_under(path):
+                        self.record_remove(song)
+                else:
+                    self.record_remove(path)
+
+
+    def moved(self, old, new, is_folder):
+        # A song or a folder was moved within the watched folder.
+        if not is_folder:
+            if self.is_song(old) and self.is_song(new):
+                self.record_rename(old, new)
+            elif self.is_song(old):
+                self.record_remove(old)
+            elif self.is_song(new):
+                self.record_add(new)  # For example a download renamed from .part to .mp3
+            return
+        for song in self.songs_under(old):
+            self.record_rename(song, new + song[len(old):])
+        prefix = old + os.sep
+        for wd, folder in self.watches.items():
+            if folder == old or folder.startswith(prefix):
+                self.watches[wd] = new + folder[len(old):]
+
+
+    def add_folder(self, folder):
+        for song in self.watch_tree(folder):
+            self.record_add(song)
+
+
+    def expire_moves(self):
+        # Moves whose destination never showed up left the watched folder.
+        for path, is_folder in self.moves.values():
+            if not is_folder:
+                self.record_remove(path)
+                continue
+            for song in self.songs_under(path):
+                self.record_remove(song)
+            prefix = path + os.sep
+            for wd, folder in list(self.watches.items()):
+                if folder == path or folder.startswith(prefix):
+                    self.libc.inotify_rm_watch(self.fd, wd)
+                    del self.watches[wd]
+        self.moves.clear()
+
+
+    def resync(self):
+        try:
+            self.reconcile(self.list_songs())
+        except OSError as e:
+            print(f"Error listing {self.directory}: {e}")
+
+
+    def reconcile(self, current):
+        # Records the difference between the known songs and a listing.
+        current = set(current)
+        for path in current - self.known:
+            self.record_add(path)
+        for path in self.known - current:
+            self.record_remove(path)
+
+
+    # Polling
+
+    def poll(self):
+        first = True  # The first listing catches up with the changes made since the folder was loaded
+        while first or not self.stop_event.wait(self.poll_interval / 1000):
+            first = False
+            try:
+                current = self.list_songs()
+            except OSError as e:
+                print(f"Error listing {self.directory}: {e}")
+                continue
+            with self.lock:
+                self.compare(current)
+
+
+    def list_songs(self):
+        # Returns {song: inode} for the whole folder, subfolders whose mtime didn't change aren't listed again.
+        songs = {}
+        folders = {}
+        pending = [""]
+        while pending:
+            folder = pending.pop()
+            path = os.path.join(self.directory, folder)
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+                listing = self.folders.get(folder)
+                if listing is None or listing[0] != mtime_ns:
+                    files, subfolders = {}, []
+                    with os.scandir(path) as entries:
+                        for entry in entries:
+                            relative = os.path.join(folder, entry.name) if folder else entry.name
+                            if entry.is_dir():
+                                subfolders.append(relative)
+                            elif self.is_song(entry.name) and entry.is_file():
+                                files[relative] = entry.inode()
+                    listing = (mtime_ns, files, subfolders)
+            except OSError:
+                continue  # Removed meanwhile
+            folders[folder] = listing
+            songs.update(listing[1])
+            pending.extend(listing[2])
+        self.folders = folders
+        return songs
+
+
+    def compare(self, current):
+        # Turns the difference between two listings into changes. A song that disappeared while another one
+        # with the same inode appeared was renamed, new songs are only reported once their size stops changing.
+        gone = [path for path in self.known if path not in current]
+        inodes = {inode: path for path, inode in self.inodes.items() if path in gone and inode} if gone else {}
+        for path, inode in current.items():
+            if path in self.known:
+                continue
+            old = inodes.pop(inode, None) if inode else None
+            if old is not None:
+                self.record_rename(old, path)
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, path))
+            except OSError:
+                continue
+            if self.unsettled.get(path) == (stat.st_size, stat.st_mtime_ns):
+                del self.unsettled[path]
+                self.record_add(path)
+            else:
+                self.unsettled[path] = (stat.st_size, stat.st_mtime_ns)  # Still being written, check again next time
+        for path in gone:
+            self.record_remove(path)
+        self.unsettled = {path: stamp for path, stamp in self.unsettled.items() if path in current}
+        self.inodes = current
+
+
+script_dir = os.path.dirname(os.path.abspath(__file__))  # Get the directory of this file, data files are kept next to it
+assets = AssetCache(os.path.join(script_dir, "imgs"))  # Images and fonts shared by all screens
+login_state_path = os.path.join(script_dir, "login_state.pkl")  # Login state file of older versions
+session_store = SessionStore(os.path.join(script_dir, "session.pkl"),  # Session state, written in the background
+                             legacy_state_path=login_state_path, legacy_info_path=os.path.join(script_dir, "login_info.pkl"))
+atexit.register(session_store.flush)
+credential_store = CredentialStore(os.path.join(script_dir, "users.db"),  # User accounts
+                                   legacy_path=os.path.join(script_dir, "user_data.pkl"))
+instrumentation = Instrumentation(enabled=os.environ.get("ULTRA_INSTRUMENT") == "1" or "--instrument" in sys.argv)  # Latency spans
+data_home = {"win32": os.environ.get("APPDATA"), "darwin": os.path.expanduser("~/Library/Application Support")}.get(sys.platform)
+user_data_dir = os.path.join(data_home or os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"), "Ultra")  # Stall log and profiles
+session_profiler = SessionProfiler(user_data_dir)  # Ctrl+Shift+P
+lag_monitor = None  # LagMonitor, created with the Tk root
+PCM_CACHE_BYTES = 0  # Decoded audio kept for instant replay, 0 turns it off (200 * 1024 * 1024 holds about 20 minutes of CD-quality audio)
+pcm_cache = PcmCache(PCM_CACHE_BYTES)  # Recently played and upcoming songs, decoded
+background_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="background")  # Slow calls off the Tk thread
+PASSWORD_HASHING = {"algorithm": "scrypt", "n": 2 ** 15, "r": 8, "p": 1,  # scrypt cost (about 32 MB and a few hundred ms)
+                    "iterations": 600000}  # PBKDF2-SHA256 cost, used where scrypt isn't available
+library_index = LibraryIndex(os.path.join(script_dir, "library.db"))  # Persistent library index (stored next to users.db)
+metadata_service = MetadataService(library_index)  # Cached song durations and tags
+LOUDNESS_TARGET = -18.0  # Loudness in dBFS that every song is played at, None turns normalization off
+loudness_analyzer = LoudnessAnalyzer(library_index, LOUDNESS_TARGET)  # Per-song gain, needs numpy
+waveform_service = WaveformService(os.path.join(script_dir, "waveforms"))  # Overviews under the seek bar, needs numpy
+METADATA_KEYS = ("duration", "title", "artist", "album", "bitrate", "format")  # Metadata stored for every song
+pygame = None  # Audio stack, imported by load_audio_stack()
+mixer = None  # pygame.mixer, handling audio playback in the music player
+MUSIC_END = None  # Posted by the mixer when a song reaches the end of its stream
+audio_lock = threading.Lock()  # The audio stack is imported by the preloader or the first song, whichever comes first
+TAG_READERS = {"mp3": ("mutagen.mp3", "EasyMP3"), "flac": ("mutagen.flac", "FLAC"),  # mutagen class reading each format
+               "ogg": ("mutagen.oggvorbis", "OggVorbis"), "opus": ("mutagen.oggopus", "OggOpus"),
+               "wav": ("mutagen.wave", "WAVE"), "m4a": ("mutagen.easymp4", "EasyMP4")}
+TAG_KEYS = {"wav": ("TIT2", "TPE1", "TALB")}  # Title, artist and album keys where they aren't "title", "artist" and "album"
+
+
+# Function to import pygame, which takes a while, so it's done after the first screen is shown.
+def load_audio_stack():
+    global pygame, mixer, MUSIC_END
+    with audio_lock:
+        if mixer is None:
+            pygame = importlib.import_module("pygame")
+            MUSIC_END = pygame.USEREVENT + 1
+            mixer = importlib.import_module("pygame.mixer")
+
+
+# Function to import the audio stack and the tag readers on a background thread.
+def preload_in_background():
+    def preload():
+        load_audio_stack()
+        for module, _ in TAG_READERS.values():
+            importlib.import_module(module)
+
+    threading.Thread(target=preload, name="preload", daemon=True).start()
+
+
+# Function to print how long the program took to show its first screen (--startup-time).
+def report_startup_time(root):
+    root.update()  # Draw the first screen
+    elapsed = time.perf_counter() - START_TIME
+    print(f"Time to first frame: {elapsed * 1000:.0f} ms")
+    loaded = [name for name in ("pygame", "mutagen") if name in sys.modules]
+    print(f"Loaded before the first frame: {', '.join(loaded) or 'no audio or tag libraries'}")
+
+
+# Function to tell whether the player is busy (a song plays, or the timing panel is open or recording),
+# the lag monitor stops once there was no input for a while otherwise.
+def player_busy(screens):
+    player = screens.screens.get(MusicPlayerScreen)
+    if instrumentation.enabled:
+        return True
+    return player is not None and (player.is_playing or player.debug_panel.window is not None)
+
+
+# Function to load login state (whether the user should stay logged in).
+def load_login_state():
+    return session_store.get("stay_logged_in"), session_store.get("username")
+
+
+# Function to save the login state.
 def save_login_state(stay_logged_in, username):
-    try:
-        with open(login_state_path, "wb") as file:  # Open the file in binary write mode
-            pickle.dump({"stay_logged_in": stay_logged_in, "username": username}, file)  # Save the login state
-    except Exception as e:
-        print(f"Error saving login state: {e}")  # Print any errors while saving the state
+    session_store.update(stay_logged_in=stay_logged_in, username=username)
 
 
 # Function to load songs from a selected directory.
@@ -1160,15 +4454,92 @@ def load_songs_from_directory():
             directory = os.path.abspath(directory)   # Convert the directory path to an absolute path
             print(f"Loading songs from: {directory}")  # Print the directory being loaded
 
-            tracks = os.listdir(directory)  # List all files in the directory
-            for track in tracks:  # Loop through each track in the directory
-                if track.endswith('.mp3'):  # Only load mp3 files
+            # Walk the directory (and its subfolders) through the library index
+            for names in library_index.scan_batches(directory):
+                for track, size, mtime_ns in names:
                     song_path = os.path.join(directory, track)  # Construct the full song path
                     print(f"Loaded song: {song_path}")  # Print the loaded song path
     except Exception as e:
         print(f"Error loading songs: {e}")  # Print any errors that occur during song loading
 
 
+# Function to run a slow call on a worker thread and hand the finished future back to the Tk loop.
+def run_in_background(root, on_done, function, *args, executor=None):
+    future = (executor or background_executor).submit(function, *args)
+
+    def check():
+        if future.done():
+            on_done(future)
+        else:
+            root.after(30, check)  # Check again shortly
+
+    root.after(30, check)
+
+
+# Function to map the indices of a list to their new indices once the removed ones are taken out (-1 for those).
+def removal_mapping(size, removed):
+    removed = set(removed)
+    mapping = array("l", [-1]) * size
+    new = 0
+    for index in range(size):
+        if index not in removed:
+            mapping[index] = new
+            new += 1
+    return mapping
+
+
+# Function to get the algorithm new password hashes use: the one in PASSWORD_HASHING, or PBKDF2 where Python was built
+# without scrypt (it needs OpenSSL 1.1+). Hashes made with it count as current.
+def password_algorithm():
+    if PASSWORD_HASHING["algorithm"] == "scrypt" and hasattr(hashlib, "scrypt"):
+        return "scrypt"
+    return "pbkdf2_sha256"
+
+
+# Function to hash a password with a random salt, using the cost settings in PASSWORD_HASHING.
+def hash_password(password):
+    salt = os.urandom(16)
+    if password_algorithm() == "scrypt":
+        n, r, p = PASSWORD_HASHING["n"], PASSWORD_HASHING["r"], PASSWORD_HASHING["p"]
+        key = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+        return f"scrypt${n}${r}${p}${salt.hex()}${key.hex()}"
+    iterations = PASSWORD_HASHING["iterations"]
+    key = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${key.hex()}"
+
+
+# Function to check a password against a saved one.
+# Returns (matches, needs_rehash), needs_rehash is True for plaintext entries and outdated cost settings.
+def verify_password(password, saved):
+    parts = saved.split("$")
+    if parts[0] == "scrypt" and len(parts) == 6:
+        n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+        key = hashlib.scrypt(password.encode(), salt=bytes.fromhex(parts[4]), n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+        matches = hmac.compare_digest(key.hex(), parts[5])
+        current = password_algorithm() == "scrypt" and (n, r, p) == (PASSWORD_HASHING["n"], PASSWORD_HASHING["r"], PASSWORD_HASHING["p"])
+    elif parts[0] == "pbkdf2_sha256" and len(parts) == 4:
+        key = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(parts[2]), int(parts[1]))
+        matches = hmac.compare_digest(key.hex(), parts[3])
+        current = password_algorithm() == "pbkdf2_sha256" and int(parts[1]) == PASSWORD_HASHING["iterations"]
+    else:
+        matches = hmac.compare_digest(saved.encode(), password.encode())  # Plaintext from older versions
+        current = False
+    return matches, matches and not current
+
+
+# Function to check a login, run on a worker thread. Returns "unknown", "incorrect" or "ok".
+def check_credentials(username, password):
+    saved_password = credential_store.get_password(username)  # Looks up only this user's record.
+    if saved_password is None:
+        return "unknown"
+    matches, needs_rehash = verify_password(password, saved_password)
+    if not matches:
+        return "incorrect"
+    if needs_rehash:
+        credential_store.set_password(username, hash_password(password))  # Plaintext entries are hashed on first login
+    return "ok"
+
+
 # Function to truncate long song names to a specified maximum length.
 def truncate_song_name(song_name, max_length=25):
 
@@ -1177,20 +4548,66 @@ def truncate_song_name(song_name, max_length=25):
     return song_name  # Return the original name if it's within the limit
 
 
-# Function to get the duration of an mp3 file.
+# Function to get the duration of a song file.
 def get_song_duration(file_path):
-    audio = MP3(file_path)  # Open the mp3 file using the MP3 class
-    return audio.info.length  # Return the duration of the song in seconds
+    metadata = metadata_service.get(file_path)  # Only parses the file if it isn't cached yet
+    return metadata["duration"] or 0  # Return the duration of the song in seconds
+
+
+# Function to read the format, duration and tags of a song file. The format comes from its magic bytes and picks
+# the mutagen class that reads the rest, so a mislabeled file is read by the right one.
+# Errors reading the file are raised, so they aren't cached as an unsupported file like a damaged header is.
+def read_song_tags(file_path):
+    metadata = dict.fromkeys(METADATA_KEYS)
+    song_format = detect_format(file_path)
+    if song_format is None:
+        print(f"Not a supported audio file: {file_path}")
+        return metadata
+    metadata["format"] = song_format
+
+    module, name = TAG_READERS[song_format]
+    try:
+        audio = getattr(importlib.import_module(module), name)(file_path)  # Imported on first use
+    except Exception as e:
+        print(f"Error reading tags from {file_path}: {e}")
+        return metadata
+    tags = audio.tags or {}
+    for key, tag in zip(("title", "artist", "album"), TAG_KEYS.get(song_format, ("title", "artist", "album"))):
+        values = tags.get(tag)
+        values = getattr(values, "text", values)  # ID3 frames of WAV files hold their values in text
+        if values:
+            metadata[key] = str(values[0])  # Tags can hold several values, keep the first
+    metadata["duration"] = audio.info.length
+    metadata["bitrate"] = audio.info.bitrate or None  # 0 where the header doesn't give it
+    return metadata
 
 
 # Main entry for running the program
 if __name__ == "__main__":
     root = CTk()  # Create the main program window
+    screens = ScreenManager(root)  # Creates each screen once and switches between them
     stay_logged_in, username = load_login_state()  # Load the login state
 
     if stay_logged_in:  # Check if the user wants to stay logged in
-        MusicPlayerScreen(root, stay_logged_in=True, username=username).show()  # Show the music player screen
+        screens.show(MusicPlayerScreen, stay_logged_in=True, username=username)  # Show the music player screen
     else:
-        LoginScreen(root).show()  # Otherwise, show the login screen (if the there no stay logged in activated)
-    
+        screens.show(LoginScreen)  # Otherwise, show the login screen (if the there no stay logged in activated)
+
+    if "--startup-time" in sys.argv:
+        report_startup_time(root)  # Measure and quit
+        root.destroy()
+        sys.exit()
+
+    root.after(100, preload_in_background)  # Audio and tag libraries load while the first screen is up
+    lag_monitor = LagMonitor(root, os.path.join(user_data_dir, "ui_stalls.log"), busy=lambda: player_busy(screens))  # Logs where the UI freezes
+    if os.environ.get("ULTRA_LAG_MONITOR") == "1" or "--lag-monitor" in sys.argv:
+        lag_monitor.start()
+    root.bind("<Control-P>", lambda e: session_profiler.toggle())  # Ctrl+Shift+P
     root.mainloop()  # Start the CustomTkinter main loop to run the program
+    lag_monitor.stop()
+    if session_profiler.running():
+        session_profiler.toggle()  # Write the profile of an unfinished session
+    screens.close()  # Destroy the screens' widgets
+    metadata_service.close()  # Drop the queued tag parsing
+    loudness_analyzer.close()  # Stop the worker processes
+    waveform_service.close()
@@ -0,0 +1,431 @@
+# Headless benchmark of the music player's hot paths.
+# Runs without a display or sound card: SDL uses its dummy drivers and the Tk widgets are replaced by stand-ins,
+# the playlist, scanning, metadata, play order and login code that runs is the real one from Ultra.py.
+#
+#   python benchmark.py --songs 500 --repeat 5 --output results.json
+#
+# The results are written as JSON so runs of different versions can be compared.
+
+import argparse  # Command line options
+from array import array  # Playlist rows of the track table
+import contextlib  # Silences the player's debug prints while timing
+import heapq  # Scheduled callbacks of the stand-in root
+import io  # Sink for the debug prints
+import json  # Machine-readable results
+import os  # File handling
+import platform  # Recorded with the results
+import shutil  # Removes the generated library
+import statistics  # Median of the runs
+import struct  # Builds the synthetic MP3 files
+import subprocess  # Version of the code being measured
+import sys  # Python version
+import tempfile  # Work directory for the library and the databases
+import time  # Timing
+
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")  # No sound card needed
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")  # The mixer's end event needs the event system, not a window
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import Ultra  # The player being measured
+
+
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x00"  # MPEG-1 layer III, 128 kbit/s, 44.1 kHz, stereo
+MP3_FRAME_LENGTH = 417  # 144 * 128000 / 44100 bytes
+MP3_FRAMES_PER_SECOND = 44100 / 1152
+
+
+# StandIn: Accepts any widget call and remembers the configured options, used in place of the Tk widgets.
+class StandIn:
+    def __init__(self, *args, **options):
+        self.options = dict(options)
+        self.value = options.get("value", 0)
+
+    def __getattr__(self, name):
+        return lambda *args, **options: None  # place, pack, bind, title, geometry...
+
+    def configure(self, **options):
+        self.options.update(options)
+
+    def cget(self, option):
+        return self.options.get(option, 0)
+
+    def get(self):
+        return self.value
+
+    def set(self, *value):
+        self.value = value[0] if len(value) == 1 else value  # Variables and sliders take one value, scrollbars two
+
+    def select(self):
+        self.value = 1
+
+    def deselect(self):
+        self.value = 0
+
+    def winfo_width(self):
+        return self.options.get("width", 400)
+
+    def winfo_children(self):
+        return []
+
+    def measure(self, text):
+        return 7 * len(text)  # Font metrics
+
+    def metrics(self, option):
+        return 16
+
+
+# StandInRoot: Root window stand-in with a small scheduler, run() plays the part of mainloop.
+class StandInRoot(StandIn):
+    def __init__(self):
+        super().__init__()
+        self.pending = []  # (due time, sequence, callback id, function, args)
+        self.cancelled = set()
+        self.sequence = 0
+
+    def after(self, ms, function=None, *args):
+        self.sequence += 1
+        callback_id = f"after#{self.sequence}"
+        heapq.heappush(self.pending, (time.perf_counter() + ms / 1000, self.sequence, callback_id, function, args))
+        return callback_id
+
+    def after_idle(self, function, *args):
+        return self.after(0, function, *args)
+
+    def after_cancel(self, callback_id):
+        self.cancelled.add(callback_id)
+
+    def state(self):
+        return "normal"
+
+    def run(self, until, timeout=600):
+        # Runs the due callbacks until the condition holds.
+        deadline = time.perf_counter() + timeout
+        while not until():
+            if time.perf_counter() > deadline:
+                raise TimeoutError("Benchmark step didn't finish")
+            if not self.pending:
+                time.sleep(0.001)
+                continue
+            due, _, callback_id, function, args = self.pending[0]
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(min(delay, 0.001))
+                continue
+            heapq.heappop(self.pending)
+            if callback_id in self.cancelled:
+                self.cancelled.discard(callback_id)
+                continue
+            function(*args)
+
+
+# HeadlessListView: The real VirtualListView (list handling and row pool redraw) drawing on a stand-in canvas.
+class HeadlessListView(Ultra.VirtualListView):
+    def __init__(self, master, width=60, height=15, font=None, bg="white", fg="black",
+                 selectbackground="#4169E1", selectforeground="white", formatter=str, on_activate=None, items=None):
+        self.items = [] if items is None else items
+        self.shown = None
+        self.selected = None
+        self.formatter = formatter
+        self.on_activate = on_activate
+        self.font = StandIn()
+        self.row_height = self.font.metrics("linespace") + 2
+        self.visible_rows = height
+        self.view_height = self.row_height * height
+        self.offset = 0
+        self.colors = (bg, fg, selectbackground, selectforeground)
+        self.redraw_id = None
+        self.canvas = StandIn(width=self.font.measure("0") * width)
+        self.scrollbar = StandIn()
+        self.rows = [[2 * row, 2 * row + 1, None, None] for row in range(height + 1)]
+
+    def after_idle(self, function, *args):
+        return root.after_idle(function, *args)
+
+    def after_cancel(self, callback_id):
+        root.after_cancel(callback_id)
+
+    def pack(self, **options):
+        pass
+
+
+root = StandInRoot()  # Shared by the player and the list stand-in
+
+
+# Function to replace the Tk widgets used by the player with stand-ins.
+def use_stand_in_widgets():
+    for name in ("CTkFrame", "CTkLabel", "CTkButton", "CTkCheckBox", "CTkSlider", "CTkEntry", "CTkProgressBar",
+                 "CTkImage", "CTkFont", "StringVar", "IntVar", "Toplevel", "Label", "Button", "Canvas"):
+        setattr(Ultra, name, StandIn)
+    Ultra.VirtualListView = HeadlessListView
+    Ultra.assets.image = lambda name, size: StandIn()  # No image decoding
+
+
+# Function to write an ID3v2 tag with a title and artist.
+def id3_tag(title, artist):
+    frames = b""
+    for frame_id, text in ((b"TIT2", title), (b"TPE1", artist)):
+        data = b"\x03" + text.encode()  # UTF-8 text
+        frames += frame_id + struct.pack(">I", len(data)) + b"\x00\x00" + data
+    size = len(frames)
+    synchsafe = bytes(((size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f))
+    return b"ID3\x03\x00\x00" + synchsafe + frames
+
+
+# Function to write an MP3 file of silent frames with an ID3v2 title and artist.
+def write_mp3(path, title, artist, seconds):
+    frame = MP3_FRAME_HEADER + bytes(MP3_FRAME_LENGTH - len(MP3_FRAME_HEADER))
+    with open(path, "wb") as file:
+        file.write(id3_tag(title, artist))
+        file.write(frame * max(1, int(seconds * MP3_FRAMES_PER_SECOND)))
+
+
+# Function to write a WAV file of silence with an ID3v2 title and artist in an "id3 " chunk.
+def write_wav(path, title, artist, seconds):
+    data = bytes(int(seconds * 44100) * 4)  # 16-bit stereo
+    tag = id3_tag(title, artist)
+    chunks = (b"fmt " + struct.pack("<IHHIIHH", 16, 1, 2, 44100, 44100 * 4, 4, 16)
+              + b"data" + struct.pack("<I", len(data)) + data + b"id3 " + struct.pack("<I", len(tag)) + tag + b"\x00" * (len(tag) & 1))
+    with open(path, "wb") as file:
+        file.write(b"RIFF" + struct.pack("<I", 4 + len(chunks)) + b"WAVE" + chunks)
+
+
+# Function to build a Vorbis comment block (FLAC, Ogg Vorbis and Opus).
+def vorbis_comment(title, artist):
+    entries = [f"TITLE={title}".encode(), f"ARTIST={artist}".encode()]
+    return (struct.pack("<I", 9) + b"benchmark" + struct.pack("<I", len(entries))
+            + b"".join(struct.pack("<I", len(entry)) + entry for entry in entries))
+
+
+# The following writers only produce valid headers (the audio is zeros), which is all the tag readers read.
+
+def write_flac(path, title, artist, seconds):
+    samples = int(seconds * 44100)
+    info = struct.pack(">HH", 4096, 4096) + bytes(6) + struct.pack(">Q", (44100 << 44) | (1 << 41) | (15 << 36) | samples) + bytes(16)
+    comment = vorbis_comment(title, artist)
+    with open(path, "wb") as file:
+        file.write(b"fLaC" + bytes((0,)) + len(info).to_bytes(3, "big") + info
+                   + bytes((0x84,)) + len(comment).to_bytes(3, "big") + comment + bytes(samples // 4))
+
+
+def ogg_page(packet, granule, sequence, header_type=0):
+    lacing = bytes([255] * (len(packet) // 255) + [len(packet) % 255])
+    return (b"OggS" + bytes((0, header_type)) + struct.pack("<qII", granule, 1, sequence) + bytes(4)
+            + bytes((len(lacing),)) + lacing + packet)
+
+
+def write_ogg(path, title, artist, seconds, opus=False):
+    if opus:
+        identification = b"OpusHead" + struct.pack("<BBHIhB", 1, 2, 312, 48000, 0, 0)
+        comment, granule = b"OpusTags" + vorbis_comment(title, artist), int(seconds * 48000) + 312
+    else:
+        identification = b"\x01vorbis" + struct.pack("<IBIiiiBB", 0, 2, 44100, 0, 128000, 0, 0xB8, 1)
+        comment, granule = b"\x03vorbis" + vorbis_comment(title, artist) + b"\x01", int(seconds * 44100)
+    with open(path, "wb") as file:
+        file.write(ogg_page(identification, 0, 0, 2) + ogg_page(comment, 0, 1)
+                   + ogg_page(bytes(int(seconds * 2000) % 254), granule, 2, 4))
+
+
+def mp4_atom(kind, payload):
+    return struct.pack(">I", 8 + len(payload)) + kind + payload
+
+
+def write_m4a(path, title, artist, seconds):
+    items = b"".join(mp4_atom(kind, mp4_atom(b"data", struct.pack(">II", 1, 0) + text.encode()))
+                     for kind, text in ((b"\xa9nam", title), (b"\xa9ART", artist)))
+    mvhd = mp4_atom(b"mvhd", bytes(12) + struct.pack(">II", 1000, int(seconds * 1000)) + bytes(80))
+    moov = mp4_atom(b"moov", mvhd + mp4_atom(b"udta", mp4_atom(b"meta", bytes(4) + mp4_atom(b"ilst", items))))
+    with open(path, "wb") as file:  # moov after mdat, as written by many encoders
+        file.write(mp4_atom(b"ftyp", b"M4A " + bytes(4) + b"M4A isom") + mp4_atom(b"mdat", bytes(int(seconds * 16000))) + moov)
+
+
+SONG_WRITERS = {"mp3": write_mp3, "wav": write_wav, "flac": write_flac, "ogg": write_ogg,
+                "opus": lambda path, title, artist, seconds: write_ogg(path, title, artist, seconds, opus=True),
+                "m4a": write_m4a}
+
+
+# Function to generate a library of synthetic songs, returns the file names.
+def generate_library(directory, songs, seconds):
+    os.makedirs(directory, exist_ok=True)
+    names = []
+    for number in range(songs):
+        name = f"{number:06d} - Artist {number % 97} - Song {number}.mp3"
+        write_mp3(os.path.join(directory, name), f"Song {number}", f"Artist {number % 97}", seconds)
+        names.append(name)
+    return names
+
+
+# Function to time a step several times, returns min/median/mean in milliseconds.
+def measure(step, repeat, items=1, setup=None):
+    timings = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            step()
+            timings.append((time.perf_counter() - start) * 1000)
+    result = {"runs": repeat, "items": items, "min_ms": min(timings), "median_ms": statistics.median(timings),
+              "mean_ms": statistics.mean(timings)}
+    result["per_item_ms"] = result["median_ms"] / items
+    return result
+
+
+# Function to give the player a fresh library index and metadata cache.
+def reset_library(work_directory):
+    Ultra.metadata_service.close()  # It is replaced below
+    database = os.path.join(work_directory, "library.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(database + suffix):
+            os.remove(database + suffix)
+    Ultra.library_index = Ultra.LibraryIndex(database)
+    Ultra.metadata_service = Ultra.MetadataService(Ultra.library_index)
+
+
+def code_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    work_directory = args.workdir or tempfile.mkdtemp(prefix="ultra-benchmark-")
+    library = os.path.join(work_directory, "library")
+    print(f"Generating {args.songs} songs of {args.seconds} s in {library}...")
+    names = generate_library(library, args.songs, args.seconds)
+    paths = [os.path.join(library, name) for name in names]
+
+    use_stand_in_widgets()
+    Ultra.loudness_analyzer.enabled = False  # Run in other processes, not part of the measured paths
+    Ultra.waveform_service.enabled = False
+    Ultra.filedialog.askdirectory = lambda **options: library  # "Load Songs" picks the generated library
+    with contextlib.redirect_stdout(io.StringIO()):
+        player = Ultra.MusicPlayerScreen(root, username="benchmark")
+    player.gapless_cb.select()
+    results = {}
+
+    def load_songs():
+        player.load(player.playlist_listbox)
+        root.run(lambda: player.scanner is None)
+
+    # Directory load (scan and playlist population), with an empty and with a filled library index
+    results["directory_load_cold"] = measure(load_songs, args.repeat, len(names), setup=lambda: reset_library(work_directory))
+    results["directory_load_warm"] = measure(load_songs, args.repeat, len(names))
+
+    # Library scan alone, without the scanner's polling: an unchanged folder is answered from the index
+    results["library_scan_cold"] = measure(lambda: Ultra.library_index.scan(library), args.repeat, len(names),
+                                           setup=lambda: reset_library(work_directory))
+    results["library_scan_warm"] = measure(lambda: Ultra.library_index.scan(library), args.repeat, len(names))
+
+    # Duration extraction: parsing every file, then from the in-memory cache, then from the library index
+    def read_durations():
+        for path in paths:
+            Ultra.get_song_duration(path)
+
+    def clear_tags():
+        reset_library(work_directory)
+        Ultra.library_index.scan(library)
+
+    results["durations_parse"] = measure(read_durations, args.repeat, len(paths), setup=clear_tags)
+    results["durations_memory"] = measure(read_durations, args.repeat, len(paths))
+    results["durations_index"] = measure(read_durations, args.repeat, len(paths),
+                                         setup=lambda: setattr(Ultra, "metadata_service", Ultra.MetadataService(Ultra.library_index)))
+
+    # Tag reading (format from the magic bytes, duration and tags by mutagen) per format, files are named .mp3 whatever their format
+    probe_directory = os.path.join(work_directory, "formats")
+    os.makedirs(probe_directory, exist_ok=True)
+    for song_format, write in SONG_WRITERS.items():
+        probe_paths = [os.path.join(probe_directory, f"{song_format} {number}.mp3") for number in range(args.probe_files)]
+        for number, path in enumerate(probe_paths):
+            write(path, f"Song {number}", f"Artist {number % 97}", args.seconds)
+        results[f"probe_{song_format}"] = measure(lambda: [Ultra.read_song_tags(path) for path in probe_paths],
+                                                  args.repeat, len(probe_paths))
+
+    # Playlist population alone (track table and rows), in the scanner's batches
+    entries = Ultra.library_index.scan(library)
+
+    def populate():
+        tracks = Ultra.TrackTable()
+        listbox = HeadlessListView(None, formatter=tracks.label, items=array("I"))
+        for first in range(0, len(entries), 500):
+            listbox.insert("end", *tracks.add(library, entries[first:first + 500]))
+            player.play_order.resize(listbox.size())
+        listbox.redraw()
+
+    results["playlist_population"] = measure(populate, args.repeat, len(names))
+
+    # Shuffle on and off (turning it on also starts the next song), next and previous
+    load_songs()
+    player.current_index.set(0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        player.play_song(player.playlist_listbox, player.song_status, player.current_index)
+
+    def toggle_shuffle():
+        player.shuffle_playlist(player.playlist_listbox)
+        player.shuffle_playlist(player.playlist_listbox)
+
+    def skip(step):
+        def steps():
+            for _ in range(args.skips):
+                step(player.playlist_listbox, player.current_index)
+        return steps
+
+    results["shuffle_playlist"] = measure(toggle_shuffle, args.repeat)
+    results["next_song"] = measure(skip(player.next_song), args.repeat, args.skips)
+    results["previous_song"] = measure(skip(player.previous_song), args.repeat, args.skips)
+    player.engine.stop()
+
+    # Search: every keystroke of a query typed into the search box, over a playlist of generated names
+    search_index = Ultra.SearchIndex()
+    search_index.add(search_index.generation, ((number, f"{number:06d} - Artist {number % 97} - Song {number}")
+                                               for number in range(args.search_rows)))
+    query = "artist 42 song 1"
+
+    def type_query():
+        for length in range(1, len(query) + 1):
+            search_index.search(query[:length])
+
+    results["search_keystroke"] = measure(type_query, args.repeat, len(query))
+
+    # Login: password check of a known user (includes the password hash) and a lookup of an unknown one
+    store = Ultra.CredentialStore(os.path.join(work_directory, "users.db"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        saved = Ultra.hash_password("Benchmark1!")
+    with store.connect():
+        store.connection.executemany("INSERT OR REPLACE INTO users (username, password) VALUES (?, ?)",
+                                     ((f"user{number}", saved) for number in range(args.users)))
+    Ultra.credential_store = store
+    results["login_known_user"] = measure(lambda: Ultra.check_credentials(f"user{args.users // 2}", "Benchmark1!"), args.repeat)
+    results["login_unknown_user"] = measure(lambda: Ultra.check_credentials("nobody", "Benchmark1!"), args.repeat)
+
+    Ultra.metadata_service.close()
+    if not args.workdir and not args.keep:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    return {"version": code_version(), "python": sys.version.split()[0], "platform": platform.platform(),
+            "songs": args.songs, "seconds_per_song": args.seconds, "users": args.users,
+            "tk": "stand-in", "audio_driver": os.environ["SDL_AUDIODRIVER"], "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless benchmark of the Ultra music player.")
+    parser.add_argument("--songs", type=int, default=200, help="songs in the generated library")
+    parser.add_argument("--seconds", type=float, default=5, help="length of each generated song")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each step")
+    parser.add_argument("--skips", type=int, default=20, help="songs skipped per next/previous run")
+    parser.add_argument("--users", type=int, default=1000, help="accounts in the user database")
+    parser.add_argument("--probe-files", type=int, default=200, help="files of each format probed")
+    parser.add_argument("--search-rows", type=int, default=100000, help="playlist entries in the search index")
+    parser.add_argument("--workdir", help="directory for the library and databases (kept afterwards)")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary work directory")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file for the results")
+    args = parser.parse_args()
+
+    report = run(args)
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    for name, result in report["results"].items():
+        print(f"{name:<22} median {result['median_ms']:10.2f} ms   per item {result['per_item_ms']:9.4f} ms")
+    print(f"Results written to {args.output}")